@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""Hastily written benchmark driver
+
+Each benchmark builds its own synthetic input, so nothing needs to be on
+disk. Run all of them, or name the ones you want:
+
+  $ python3 bench.py
+  $ python3 bench.py xml_convert
+
+These are not precise measurements, they are only meant to show the
+relative difference between two implementations on the same input
+"""
+from collections import OrderedDict
+from sys import argv, getrecursionlimit
+from timeit import timeit
+from tracemalloc import (
+    start as trace_start,
+    stop as trace_stop,
+    get_traced_memory)
+import xml.etree.cElementTree as ET
+
+from jinja2 import Template
+from yaml import (
+    dump as dump_yaml,
+    load as load_yaml,
+    SafeDumper,
+    SafeLoader)
+
+import objectify.template
+from objectify.yaml import (
+    YAML_LOADER,
+    objectify_yaml)
+from objectify.xml import (
+    _elem_to_internal,
+    _expat_to_internal,
+    _strip_tag)
+
+
+def _elem_to_internal_recursive(element,
+                                strip_ns=True,
+                                strip_whitespace=True,
+                                skip_tails=('#', ),
+                                skip_text=('\n', )):
+    """The original recursive converter, kept here for comparison only"""
+    cur_dict = OrderedDict()
+    elem_tag = element.tag
+    if strip_ns is True:
+        elem_tag = _strip_tag(element.tag)
+    for key, value in list(element.attrib.items()):
+        cur_dict['@' + key] = value
+
+    for sub_element in element:
+        cur_val = _elem_to_internal_recursive(
+            sub_element, strip_ns=strip_ns, strip_whitespace=strip_whitespace)
+        tag = sub_element.tag
+        if strip_ns is True:
+            tag = _strip_tag(sub_element.tag)
+        value = cur_val[tag]
+        try:
+            cur_dict[tag].append(value)
+        except AttributeError:
+            cur_dict[tag] = [cur_dict[tag], value]
+        except KeyError:
+            cur_dict[tag] = value
+    text = element.text
+    tail = element.tail
+    if strip_whitespace is True:
+        if text:
+            text = text.strip()
+        if tail:
+            tail = tail.strip()
+    if tail and not tail not in skip_tails:
+        cur_dict['#tail'] = tail
+    if cur_dict:
+        if text and text not in skip_text:
+            cur_dict["#text"] = text
+    else:
+        cur_dict = text or None
+    return {elem_tag: cur_dict}
+
+
+def _report(name, seconds, number):
+    """Print a single timing line"""
+    print('  {:<40} {:>10.2f} ms/run'.format(name, seconds * 1000 / number))
+
+
+def _peak_memory(func):
+    """Return the peak memory allocated while calling func, in MB"""
+    trace_start()
+    func()
+    peak = get_traced_memory()[1]
+    trace_stop()
+    return peak / (1 << 20)
+
+
+def _retained_memory(func):
+    """Return the memory still held by the result of calling func, in MB"""
+    trace_start()
+    result = func()
+    current = get_traced_memory()[0]
+    trace_stop()
+    del result
+    return current / (1 << 20)
+
+
+def _wide_xml(count=100000):
+    """A flat document with many small, mostly repeated, children"""
+    return '<root>{}</root>'.format(''.join(
+        '<item id="{0}"><name>n{0}</name><value>{0}</value></item>'.format(i)
+        for i in range(count)))
+
+
+def _deep_xml(depth):
+    """A document nested `depth` elements deep"""
+    return '<n a="1">' * depth + 'leaf' + '</n>' * depth
+
+
+def bench_xml_convert():
+    """Recursive vs. iterative _elem_to_internal on wide and deep documents"""
+    wide = ET.fromstring(_wide_xml())
+    assert _elem_to_internal(wide) == _elem_to_internal_recursive(wide)
+    print('wide document (100000 records):')
+    for name, func in (('recursive', _elem_to_internal_recursive),
+                       ('iterative', _elem_to_internal)):
+        _report(name, timeit(lambda: func(wide), number=5), 5)
+
+    depth = getrecursionlimit() // 2
+    deep = ET.fromstring(_deep_xml(depth))
+    assert _elem_to_internal(deep) == _elem_to_internal_recursive(deep)
+    print('deep document ({} levels):'.format(depth))
+    for name, func in (('recursive', _elem_to_internal_recursive),
+                       ('iterative', _elem_to_internal)):
+        _report(name, timeit(lambda: func(deep), number=20), 20)
+
+    depth = getrecursionlimit() * 10
+    deeper = ET.fromstring(_deep_xml(depth))
+    print('deeper document ({} levels):'.format(depth))
+    try:
+        _elem_to_internal_recursive(deeper)
+    except RecursionError:
+        print('  {:<40} {:>10}'.format('recursive', 'RecursionError'))
+    _report('iterative', timeit(lambda: _elem_to_internal(deeper), number=5), 5)
+
+
+def bench_xml_expat():
+    """ElementTree + _elem_to_internal vs. the direct expat builder"""
+    xmlstring = _wide_xml()
+    etree = lambda: _elem_to_internal(ET.fromstring(xmlstring))
+    expat = lambda: _expat_to_internal((xmlstring, ))
+    assert etree() == expat()
+    print('wide document (100000 records):')
+    for name, func in (('ElementTree', etree), ('expat', expat)):
+        _report(name, timeit(func, number=3), 3)
+        print('  {:<40} {:>10.2f} MB peak'.format(name, _peak_memory(func)))
+
+
+def bench_xml_compact():
+    """OrderedDict output vs. compact=True (plain dicts) output"""
+    root = ET.fromstring(_wide_xml())
+    default = lambda: _elem_to_internal(root)
+    compact = lambda: _elem_to_internal(root, compact=True)
+    funcs = (('OrderedDict', default), ('compact', compact))
+    print('wide document (100000 records):')
+    # Time both before tracing memory, a traced run leaves the heap
+    # fragmented and slows down whichever conversion is timed after it
+    for name, func in funcs:
+        _report(name, timeit(func, number=3), 3)
+    for name, func in funcs:
+        print('  {:<40} {:>10.2f} MB retained'.format(name, _retained_memory(func)))
+
+
+def _big_yaml(count=5000):
+    """A large YaML document of nested mappings and lists"""
+    return ''.join(
+        'host{0}:\n  addr: 10.0.{1}.{2}\n  ports: [22, 80, 443]\n'
+        '  tags:\n    - web\n    - "{{{{ root }}}}/{0}"\n'.format(i, i // 256 % 256, i % 256)
+        for i in range(count))
+
+
+def bench_yaml_loader():
+    """Pure Python SafeLoader vs. the loader objectify_yaml uses"""
+    yamlstring = _big_yaml()
+    print('YaML document ({:.1f} MB), objectify_yaml uses {}:'.format(
+        len(yamlstring) / (1 << 20), YAML_LOADER.__name__))
+    for loader in (SafeLoader, YAML_LOADER):
+        _report(loader.__name__, timeit(lambda: load_yaml(yamlstring, Loader=loader), number=1), 1)
+
+
+def _templated_yaml(count=300):
+    """A self-templating YaML config, most values refer to other keys"""
+    lines = ['root: /srv', 'user: admin']
+    for i in range(count):
+        lines.append('path{0}: "{{{{ root }}}}/{0}"'.format(i))
+        lines.append('home{0}: "/home/{{{{ user }}}}"'.format(i))
+        lines.append('name{0}: plain value {0}'.format(i))
+    return '\n'.join(lines)
+
+
+def bench_template_cache():
+    """objectify_yaml with Template() per string vs. the compiled template cache"""
+    yamlstring = _templated_yaml()
+    cached = objectify.template._compile_template
+    native = objectify.template._compile_native
+    print('self-templating YaML ({} values):'.format(yamlstring.count('\n') + 1))
+    # Render everything with Jinja2, the native engine would skip most of it
+    objectify.template._compile_native = lambda source: None
+    try:
+        objectify.template._compile_template = Template
+        _report('Template() per string', timeit(
+            lambda: objectify_yaml(yamlstring, from_string=True), number=1), 1)
+        objectify.template._compile_template = cached
+        cached.cache_clear()
+        _report('cached, first load', timeit(
+            lambda: objectify_yaml(yamlstring, from_string=True), number=1), 1)
+        _report('cached, later loads', timeit(
+            lambda: objectify_yaml(yamlstring, from_string=True), number=3), 3)
+    finally:
+        objectify.template._compile_template = cached
+        objectify.template._compile_native = native
+
+
+def bench_native_template():
+    """Rendering plain {{ var }} templates with Jinja2 vs. the native engine"""
+    yamlstring = _templated_yaml(count=1000)
+    native = objectify.template._compile_native
+    print('self-templating YaML ({} values):'.format(yamlstring.count('\n') + 1))
+    objectify.template._compile_native = lambda source: None
+    try:
+        objectify_yaml(yamlstring, from_string=True)
+        _report('Jinja2', timeit(
+            lambda: objectify_yaml(yamlstring, from_string=True), number=3), 3)
+    finally:
+        objectify.template._compile_native = native
+    objectify_yaml(yamlstring, from_string=True)
+    _report('native', timeit(
+        lambda: objectify_yaml(yamlstring, from_string=True), number=3), 3)
+
+
+def _aliased_yaml(count=300, size=300):
+    """A YaML document where one large templated mapping has many aliases"""
+    lines = ['root: /srv', 'base: &base']
+    for i in range(size):
+        lines.append('  key{0}: "{{{{ root }}}}/{0}"'.format(i))
+    lines.append('  list: &list [{}]'.format(', '.join('"{{{{ root }}}}/{}"'.format(i) for i in range(size))))
+    for i in range(count):
+        lines.append('host{}: {{base: *base, list: *list}}'.format(i))
+    return '\n'.join(lines)
+
+
+class _NoAliasDumper(SafeDumper):
+    """Write every alias out in full"""
+
+    def ignore_aliases(self, data):
+        return True
+
+
+def bench_template_aliases():
+    """Templating a document with anchors/aliases vs. the same one written out"""
+    shared = load_yaml(_aliased_yaml(), Loader=YAML_LOADER)
+    expanded = load_yaml(dump_yaml(shared, Dumper=_NoAliasDumper), Loader=YAML_LOADER)
+    template = objectify.template.recursive_template
+    assert template(shared, shared, copy=True) == template(expanded, expanded, copy=True)
+    print('one 600 value mapping, 300 aliases to it:')
+    for name, data in (('aliases written out', expanded), ('aliases shared', shared)):
+        _report(name, timeit(lambda: template(data, data, copy=True), number=3), 3)
+        print('  {:<40} {:>10.2f} MB peak'.format(
+            name, _peak_memory(lambda: template(data, data, copy=True))))
+
+
+BENCHMARKS = OrderedDict([
+    ('xml_convert', bench_xml_convert),
+    ('xml_expat', bench_xml_expat),
+    ('xml_compact', bench_xml_compact),
+    ('yaml_loader', bench_yaml_loader),
+    ('template_cache', bench_template_cache),
+    ('native_template', bench_native_template),
+    ('template_aliases', bench_template_aliases),
+])
+
+
+def main():
+    """Benchmark driver"""
+    names = argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print('== {} =='.format(name))
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main()
@@ -6,9 +6,18 @@ from sys import stderr
 
 from objectify.json import (
     objectify_json,
-    objectify_json_lines)
-from objectify.xml import objectify_xml
-from objectify.yaml import objectify_yaml
+    objectify_json_lines,
+    objectify_write_json_lines)
+from objectify.xml import (
+    objectify_xml,
+    objectify_xml_records,
+    objectify_xml_records_parallel,
+    objectify_xml_extract,
+    objectify_xml_extract_records)
+from objectify.yaml import (
+    objectify_yaml,
+    objectify_yaml_documents,
+    objectify_yaml_render_many)
 from objectify.io import (
     objectify_read,
     objectify_write)
@@ -22,7 +31,11 @@ BLUE = '\033[1;34m'
 logging.getLogger(__name__).addHandler(NullHandler())
 
 __all__ = ['objectify_json', 'objectify_xml', 'objectify_yaml',
-           'objectify_json_lines', 'objectify_read', 'objectify_write']
+           'objectify_json_lines', 'objectify_read', 'objectify_write',
+           'objectify_write_json_lines', 'objectify_xml_records',
+           'objectify_xml_records_parallel', 'objectify_xml_extract',
+           'objectify_xml_extract_records', 'objectify_yaml_documents',
+           'objectify_yaml_render_many']
 
 from ._version import get_versions
 __version__ = get_versions()['version']
@@ -0,0 +1,163 @@
+"""Load many small XML, YaML and JSON files at once with a pool of workers
+
+Loading tens of thousands of small files one after another spends most of
+its time waiting on I/O and on per-file overhead. objectify_batch reads
+the files with a pool of threads and hands the content to a pool of
+processes for parsing, returning (path, object or error) pairs as each
+file is done
+
+    for path, obj in objectify_batch(['configs/**/*.yml', 'feeds/*.xml']):
+        if isinstance(obj, Exception):
+            print('{} failed: {}'.format(path, obj))
+
+From the command line, each file becomes a line of JSON:
+
+    $ python3 -m objectify.batch 'configs/**/*.yml' 'feeds/*.xml' -o loaded.jsonl
+"""
+from argparse import ArgumentParser
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait)
+from glob import iglob
+from os.path import splitext
+from sys import stdout
+
+from objectify.encoding import _DEFAULT_ENCODING
+from objectify.io import objectify_read
+from objectify.pool import (
+    _pool_size,
+    _submit_bounded)
+from objectify.json import (
+    objectify_json,
+    objectify_write_json_lines)
+from objectify.xml import objectify_xml
+from objectify.yaml import objectify_yaml
+
+# Each loader is called with the file content and from_string=True
+_LOADERS = {
+    '.json': objectify_json,
+    '.xml': objectify_xml,
+    '.yaml': objectify_yaml,
+    '.yml': objectify_yaml,
+}
+
+
+def _expand(patterns):
+    """Generator returning each path matched by a list of globs or paths
+
+    Paths without any glob characters are passed through as-is, so that a
+    missing file is reported as an error rather than silently skipped
+    """
+    if isinstance(patterns, str):
+        patterns = (patterns, )
+    for pattern in patterns:
+        if any(char in pattern for char in '*?['):
+            yield from iglob(pattern, recursive=True)
+        else:
+            yield pattern
+
+
+def _parse(path, content, options):
+    """Parse the content of a file based on its extension, runs in a worker process"""
+    extension = splitext(path)[1].lower()
+    if extension not in _LOADERS:
+        raise RuntimeError('no loader for "{}" files'.format(extension))
+    return _LOADERS[extension](content, from_string=True, **options.get(extension, {}))
+
+
+def objectify_batch(patterns,
+                    workers=None,
+                    io_workers=16,
+                    ordered=True,
+                    encoding=_DEFAULT_ENCODING,
+                    options=None):
+    """Generator returning (path, object) for each XML, YaML or JSON file
+
+    patterns: a glob, a file path or an iterable of either. Globs may use
+              '**' to match recursively
+
+    Files are read by a pool of `io_workers` threads. Each thread hands the
+    content to a pool of `workers` processes for parsing (the default is one
+    per CPU), or parses it itself when workers=0, which is faster for very
+    small files where sending the result back costs more than parsing it
+
+    When loading a file fails, the exception is returned in place of the
+    object rather than raised, so one bad file does not stop the batch
+
+    ordered=True returns the files in the order they were given, otherwise
+    they are returned as soon as they are done. Either way only a bounded
+    number of files is in flight at once
+
+    options maps an extension to extra keyword arguments for its loader,
+    e.g. {'.yml': {'template': False}}
+    """
+    if options is None:
+        options = {}
+    process_pool = ProcessPoolExecutor(max_workers=workers) if workers != 0 else None
+
+    def _load(path):
+        """Read a file, then parse it in the process pool, runs in a thread"""
+        content = objectify_read(path, encoding=encoding)
+        if content is None:
+            raise OSError('unable to read {}'.format(path))
+        if process_pool is None:
+            return _parse(path, content, options)
+        return process_pool.submit(_parse, path, content, options).result()
+
+    def _result(path, future):
+        """Return the (path, object or error) pair for a finished load"""
+        try:
+            return path, future.result()
+        except (Exception, SystemExit) as err:
+            # Some loaders call exit() on bad input
+            return path, err
+
+    try:
+        with ThreadPoolExecutor(max_workers=io_workers) as io_pool:
+            max_pending = 2 * _pool_size(io_workers)
+            if ordered is True:
+                for path, future in _submit_bounded(io_pool, _load, _expand(patterns), max_pending):
+                    yield _result(path, future)
+                return
+
+            pending = {}
+            for path in _expand(patterns):
+                pending[io_pool.submit(_load, path)] = path
+                if len(pending) >= max_pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield _result(pending.pop(future), future)
+            for future in as_completed(pending):
+                yield _result(pending.pop(future), future)
+    finally:
+        if process_pool is not None:
+            process_pool.shutdown()
+
+
+def main():
+    """Command line entry point for objectify_batch"""
+    parser = ArgumentParser(description='Load many XML, YaML and JSON files as JSON lines')
+    parser.add_argument('patterns', nargs='+', help='files or globs to load')
+    parser.add_argument('-o', '--output', default=None,
+                        help='JSON lines file to write, default is stdout')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='parsing processes, default is one per CPU, 0 to parse in the I/O threads')
+    parser.add_argument('--io-workers', type=int, default=16, help='file reading threads')
+    parser.add_argument('--unordered', action='store_true',
+                        help='write each file as soon as it is done rather than in order')
+    args = parser.parse_args()
+
+    results = objectify_batch(args.patterns,
+                              workers=args.workers,
+                              io_workers=args.io_workers,
+                              ordered=not args.unordered)
+    objs = ({'path': path, 'error': repr(obj)} if isinstance(obj, BaseException)
+            else {'path': path, 'object': obj} for path, obj in results)
+    objectify_write_json_lines(args.output or stdout, objs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""Streaming conversion between file formats
+
+Each converter chains one of the generator-based loaders into one of the
+streaming writers, so records are read, serialized and written one at a
+time. Memory usage is bounded by the size of a single record, not the size
+of the file
+
+    csv_to_json_lines('in.csv', 'out.jsonl')
+    json_lines_to_csv('in.jsonl', 'out.csv', fieldnames=['id', 'email'])
+    xml_to_json_lines('nmap.xml', 'hosts.jsonl.gz', 'host')
+
+XML can also be converted from the command line:
+
+    $ python3 -m objectify.convert nmap.xml hosts.jsonl.gz --record host --progress
+"""
+from argparse import ArgumentParser
+from time import monotonic
+
+from objectify.csv import (
+    objectify_csv,
+    objectify_write_csv)
+from objectify.encoding import _DEFAULT_ENCODING
+from objectify.json import (
+    objectify_json_lines,
+    objectify_write_json_lines)
+from objectify.log import info
+from objectify.xml import (
+    objectify_xml_records,
+    objectify_xml_records_parallel)
+
+
+def _progress(objs, interval=5.0):
+    """Pass objects through, reporting the rate every `interval` seconds"""
+    start = last = monotonic()
+    count = 0
+    for count, obj in enumerate(objs, 1):
+        yield obj
+        if count % 1000 == 0:
+            now = monotonic()
+            if now - last >= interval:
+                last = now
+                info('{} records, {:.0f} records/sec'.format(count, count / (now - start)))
+    elapsed = monotonic() - start
+    info('{} records in {:.1f} seconds, {:.0f} records/sec'.format(
+        count, elapsed, count / elapsed if elapsed else 0))
+
+
+def csv_to_json_lines(in_path_buf_stream,
+                      out_path_buf_stream,
+                      encoding=_DEFAULT_ENCODING,
+                      ensure_ascii=True,
+                      **csv_kwargs):
+    """Convert a CSV file or stream to JSON lines, one row at a time
+
+    Extra keyword arguments (header, sep, quotechar, ...) are passed through
+    to objectify_csv. Returns the number of records written
+    """
+    rows = objectify_csv(in_path_buf_stream,
+                         encoding=encoding,
+                         avoid_memory_pressure=True,
+                         **csv_kwargs)
+    return objectify_write_json_lines(out_path_buf_stream, rows,
+                                      encoding=encoding,
+                                      ensure_ascii=ensure_ascii)
+
+
+def json_lines_to_csv(in_path_buf_stream,
+                      out_path_buf_stream,
+                      fieldnames=None,
+                      fatal_errors=True,
+                      encoding=_DEFAULT_ENCODING,
+                      **csv_kwargs):
+    """Convert a JSON lines file or stream to CSV, one object at a time
+
+    When `fieldnames` is not given, the keys of the first object are used as
+    the header. Extra keyword arguments (sep, quotechar, ...) are passed through
+    to objectify_write_csv. Returns the number of records written
+    """
+    objs = objectify_json_lines(in_path_buf_stream,
+                                fatal_errors=fatal_errors,
+                                encoding=encoding)
+    return objectify_write_csv(out_path_buf_stream, objs,
+                               fieldnames=fieldnames,
+                               encoding=encoding,
+                               **csv_kwargs)
+
+
+def xml_to_json_lines(in_path_buf_stream,
+                      out_path_buf_stream,
+                      record,
+                      compress=None,
+                      progress=False,
+                      workers=None,
+                      encoding=_DEFAULT_ENCODING,
+                      ensure_ascii=True,
+                      **xml_kwargs):
+    """Convert each record element of an XML file or stream to a line of JSON
+
+    One line is written per record element, `record` being a tag or path as
+    accepted by objectify_xml_records. Only one record is held in memory at
+    a time. Extra keyword arguments (strip_ns, force_list, compact, ...) are
+    passed through to objectify_xml_records
+
+    When writing to a path, the output is compressed if the path ends with
+    .gz, .bz2 or .xz, or if `compress` names one of 'gzip', 'bz2' or 'xz'
+
+    Set `workers` to convert the records in that many processes using
+    objectify_xml_records_parallel, in which case `record` must be a tag.
+    Either way the input is decoded as its XML declaration says, `encoding`
+    is only used for the output. Non-ASCII characters are escaped unless
+    `ensure_ascii=False`, which needs an output `encoding` such as 'utf-8'
+    that can represent them
+
+    Set `progress=True` to report the number of records per second to stderr
+
+    Returns the number of records written
+    """
+    if workers:
+        objs = objectify_xml_records_parallel(in_path_buf_stream, record,
+                                              as_json=True,
+                                              workers=workers,
+                                              ensure_ascii=ensure_ascii,
+                                              **xml_kwargs)
+    else:
+        objs = objectify_xml_records(in_path_buf_stream, record, **xml_kwargs)
+    if progress is True:
+        objs = _progress(objs)
+    return objectify_write_json_lines(out_path_buf_stream, objs,
+                                      encoding=encoding,
+                                      ensure_ascii=ensure_ascii,
+                                      compress=compress,
+                                      serialized=bool(workers))
+
+
+def main():
+    """Command line entry point for xml_to_json_lines"""
+    parser = ArgumentParser(description='Stream-convert XML records to JSON lines')
+    parser.add_argument('infile', help='XML file to read')
+    parser.add_argument('outfile', help='JSON lines file to write, compressed if it ends with .gz, .bz2 or .xz')
+    parser.add_argument('--record', required=True,
+                        help='tag or path of the record elements, e.g. host or /nmaprun/host')
+    parser.add_argument('--strip-ns', action='store_true', help='strip namespaces from tags')
+    parser.add_argument('--compact', action='store_true', help='build plain dicts rather than OrderedDicts')
+    parser.add_argument('--force-list', action='append',
+                        help='tag that is always a list, may be repeated')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='convert in this many processes (record must be a tag)')
+    parser.add_argument('--progress', action='store_true', help='report records/sec to stderr')
+    parser.add_argument('--unicode', action='store_true',
+                        help='write non-ASCII characters as UTF-8 rather than escaping them')
+    args = parser.parse_args()
+
+    count = xml_to_json_lines(args.infile, args.outfile, args.record,
+                              progress=args.progress,
+                              workers=args.workers,
+                              encoding='utf-8' if args.unicode else _DEFAULT_ENCODING,
+                              ensure_ascii=not args.unicode,
+                              strip_ns=args.strip_ns,
+                              compact=args.compact,
+                              force_list=args.force_list)
+    print('Conversion complete, {} records written to {} ...'.format(count, args.outfile))
+
+
+if __name__ == "__main__":
+    main()
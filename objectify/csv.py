@@ -1,14 +1,66 @@
-from csv import DictReader
+"""Load CSV files, streams or strings as rows of native Python objects"""
+from csv import (
+    reader as csv_reader,
+    writer as csv_writer,
+    DictWriter)
 from io import StringIO
+from itertools import chain
 
 from objectify.encoding import _DEFAULT_ENCODING
+from objectify.io import _WRITE_BUFFER_SIZE
 
-# data = DictReader(open(file, encoding='utf-8'))
-# for row in data:
-#     rowmap = dict(row)
-#     # print(dumps(rowmap, indent=2))
-#     cidr = rowmap['a_cidr']
-#     print(cidr)
+
+def _csv_records(infd, header=True, sep=',', quotechar='"', escapechar=None, index_row=0):
+    """Return (fieldnames, reader) for an open CSV stream
+
+    The reader is positioned just past the header row. Any rows before
+    `index_row` are skipped. When `header` is False, fieldnames is None and
+    the caller should use the raw rows as they come out of csv.reader
+    """
+    reader = csv_reader(infd, delimiter=sep, quotechar=quotechar, escapechar=escapechar)
+    for _ in range(index_row):
+        next(reader, None)
+
+    if header is True:
+        fieldnames = next(reader, None)
+    elif header:
+        # Caller provided the field names explicitly
+        fieldnames = list(header)
+    else:
+        fieldnames = None
+    return fieldnames, reader
+
+
+def _row_dict(fieldnames, row):
+    """Return a row as a dict, the same way DictReader does
+
+    Values past the end of fieldnames are kept as a list under the key None
+    and fieldnames past the end of the row get the value None
+    """
+    record = dict(zip(fieldnames, row))
+    if len(row) > len(fieldnames):
+        record[None] = list(row[len(fieldnames):])
+    elif len(row) < len(fieldnames):
+        for name in fieldnames[len(row):]:
+            record[name] = None
+    return record
+
+
+def _csv_generator(infd, fieldnames, reader):
+    """Generator yielding one row at a time, closing the stream when exhausted
+
+    Blank lines are skipped, the same way DictReader does
+    """
+    with infd:
+        if fieldnames is None:
+            # Headerless fast path, no need to turn anything into a dict
+            for row in reader:
+                if row:
+                    yield row
+            return
+        for row in reader:
+            if row:
+                yield _row_dict(fieldnames, row)
 
 
 def objectify_csv(path_buf_stream,
@@ -16,51 +68,41 @@ def objectify_csv(path_buf_stream,
                   header=True, quotechar='"', escapechar=None,
                   avoid_memory_pressure=False,
                   from_string=False, index_row=0, sep=',', unique=False):
-    """Return a native Python object from a CSV file path, stream or string
-
-    This function is specifically to minimize memory usage, suitable for processing
-    VERY large files without causing memory pressure by implementing as a generator
-    providing a single line at a time back to the caller. If this caller wants a
-    list all at once they can just wrap `list()` around the all, or just a list
-    or set comprehension, but this defeats the purpose of the function
+    """Return native Python objects from a CSV file path, stream or string
 
     in: path_buf_stream:
-      (str) A string file path containing JSON
-      (stream) An open readable stream from a file containing JSON
-      (stream) A string of JSON content (also requires `from_string=True`)
+      (str) A string file path containing CSV
+      (stream) An open readable stream from a file containing CSV
+      (stream) A string of CSV content (also requires `from_string=True`)
 
-    Note that only two comment usages are supported:
-      - Comment at beginning of line, skip entire line
-      - Single comment, ignore all content after comment character
+    header:
+      True - the row at `index_row` holds the field names, each row is a dict
+      False - there is no header, each row is a plain list from csv.reader
+      (list) - explicit field names, each row is a dict
 
-    Comments *must* be a single character, e.g. '#', NOT '<!', etc
-    By default, there is no comment defined unless `comment` is set by the caller
-
-    Examples:
+    index_row: the number of rows to skip before the header (or the data, when
+               `header` is not True)
 
-      for obj in objectify_lines('file.json', encoding='utf-8'):
-        print(line)
+    sep, quotechar, escapechar: passed through to csv.reader
 
-      lines_fd = open('lines.lst', 'r', encoding='utf-8')
-      for line in objectify_lines(json_fd):
-        print(line)
+    By default the entire file is loaded in a single pass and a list is returned.
+    To minimize memory usage on VERY large files, set `avoid_memory_pressure=True`
+    and a generator providing a single row at a time is returned instead
 
-      lines_str = 'a\nb\nc'
-        for line in objectify_lines(lines_str, from_string=True):
-          print(line)
+    unique=True removes duplicate rows, keeping the first occurrence. When there
+    is no header, the unique rows are returned as tuples. This is not possible
+    when using a generator
 
-    If the caller just wants a simple list of lines all in memory at once without
-    any concern for memory pressure simply call with a list() or use a set or list
-    comprehension:
+    Examples:
 
-    Build one large list all at once:
-      list(objectify_lines('file.lst', encoding='utf-8'))
+      for row in objectify_csv('file.csv', avoid_memory_pressure=True):
+        print(row['id'])
 
-    Alternately, use a list comprehension for transforming lines along the way:
-      [line.upper() for line in objectify_lines('file.lst', encoding='utf-8')]
+      csv_fd = open('file.csv', 'r', encoding='utf-8', newline='')
+      rows = objectify_csv(csv_fd, header=False, sep='\t')
 
-    To perform an unique, use a set comprehension:
-      {line.lower() for line in objectify_lines('file.lst', encoding='utf-8')}
+      csv_str = 'a,b\n1,2\n3,4'
+      rows = objectify_csv(csv_str, from_string=True)
     """
     if unique is True and avoid_memory_pressure is True:
         raise RuntimeError('Unable to enforce uniqueness when using a generator')
@@ -72,15 +114,68 @@ def objectify_csv(path_buf_stream,
 
     # If path_buf_stream has a read method, it is effectively stream
     reader = getattr(path_buf_stream, 'read', None)
-
-# reader = csv.DictReader(fileobj)
-# row = next(reader, None)
-
-    with (path_buf_stream if reader else open(path_buf_stream, 'r', encoding=encoding)) as infd:
-        dict_reader = DictReader(infd)
-        if avoid_memory_pressure is True:
-            for row in dict_reader:
-                yield dict(row)
+    infd = path_buf_stream if reader else open(path_buf_stream, 'r', encoding=encoding, newline='')
+
+    if avoid_memory_pressure is True:
+        fieldnames, rows = _csv_records(
+            infd, header=header, sep=sep, quotechar=quotechar,
+            escapechar=escapechar, index_row=index_row)
+        return _csv_generator(infd, fieldnames, rows)
+
+    with infd:
+        fieldnames, rows = _csv_records(
+            infd, header=header, sep=sep, quotechar=quotechar,
+            escapechar=escapechar, index_row=index_row)
+        if unique is True:
+            # dict.fromkeys preserves the order of first occurrence
+            rows = dict.fromkeys(tuple(row) for row in rows if row)
+        if fieldnames is None:
+            return [row for row in rows if row]
+        return [_row_dict(fieldnames, row) for row in rows if row]
+
+
+def objectify_write_csv(path_buf_stream,
+                        rows,
+                        fieldnames=None,
+                        header=True,
+                        quotechar='"', escapechar=None, sep=',',
+                        encoding=_DEFAULT_ENCODING,
+                        buffering=_WRITE_BUFFER_SIZE):
+    """Write each row from an iterable to a CSV file or stream
+
+    path_buf_stream: can be a writable stream-like object or a file path
+
+    Rows may be dicts or plain sequences. For dicts, `fieldnames` defaults to
+    the keys of the first row and keys not in `fieldnames` are ignored. For
+    sequences, the header is only written if `fieldnames` is given
+
+    Rows are written one at a time, so `rows` can be a generator such as the
+    one returned by objectify_json_lines and memory usage stays bounded
+
+    Returns the number of rows written, not including the header
+    """
+    rows = iter(rows)
+    first = next(rows, None)
+    writer = getattr(path_buf_stream, 'write', None)
+    count = 0
+    with (path_buf_stream if writer else open(
+            path_buf_stream, 'w', encoding=encoding, newline='', buffering=buffering)) as outfd:
+        if first is None:
+            return count
+        rows = chain((first, ), rows)
+        if isinstance(first, dict):
+            if fieldnames is None:
+                fieldnames = list(first)
+            out = DictWriter(outfd, fieldnames, extrasaction='ignore', delimiter=sep,
+                             quotechar=quotechar, escapechar=escapechar)
+            if header is True:
+                out.writeheader()
         else:
-            return dict(dict_reader)
-
+            out = csv_writer(outfd, delimiter=sep, quotechar=quotechar, escapechar=escapechar)
+            if header is True and fieldnames:
+                out.writerow(fieldnames)
+        writerow = out.writerow
+        for row in rows:
+            writerow(row)
+            count += 1
+    return count
@@ -1,9 +1,46 @@
 """Simple 'raw' read/write functions with basic exception handling"""
+from bz2 import open as bz2_open
+from gzip import open as gzip_open
+from lzma import open as lzma_open
 
 from objectify.encoding import _DEFAULT_ENCODING
 from objectify.log import error, error_frame
 from ujson import dump
 
+# Buffer size used when opening files for streaming writes
+_WRITE_BUFFER_SIZE = 1 << 20
+# Size of each chunk returned by objectify_read_chunks
+_READ_CHUNK_SIZE = 1 << 16
+
+_COMPRESSORS = {
+    'gzip': gzip_open,
+    'bz2': bz2_open,
+    'xz': lzma_open
+}
+_COMPRESSED_EXTENSIONS = {
+    '.gz': 'gzip',
+    '.bz2': 'bz2',
+    '.xz': 'xz'
+}
+
+
+def _open_write(path, encoding=_DEFAULT_ENCODING, compress=None, buffering=_WRITE_BUFFER_SIZE):
+    """Open a file path for writing text, optionally compressed
+
+    compress:
+      None - compress based on the file extension (.gz, .bz2 or .xz)
+      False - never compress
+      (str) - one of 'gzip', 'bz2' or 'xz'
+    """
+    if compress is None:
+        for extension, name in _COMPRESSED_EXTENSIONS.items():
+            if path.endswith(extension):
+                compress = name
+                break
+    if compress:
+        return _COMPRESSORS[compress](path, 'wt', encoding=encoding)
+    return open(path, 'w', encoding=encoding, buffering=buffering)
+
 
 def objectify_read(path_buf_stream,
                    encoding=_DEFAULT_ENCODING):
@@ -25,6 +62,30 @@ def objectify_read(path_buf_stream,
         exit(1)
 
 
+def objectify_read_chunks(path_buf_stream,
+                          encoding=_DEFAULT_ENCODING,
+                          chunk_size=_READ_CHUNK_SIZE):
+    """Generator returning a file or stream as fixed-size str or bytes chunks
+
+    path_buf_stream: can be a readable stream-like object or a file path
+
+    Unlike objectify_read, the content is never held in memory all at once,
+    which matters for sockets, pipes and decompressing streams where the
+    caller can parse each chunk as it arrives
+    """
+    reader = getattr(path_buf_stream, 'read', None)
+    try:
+        with (path_buf_stream if reader else open(path_buf_stream, 'r', encoding=encoding)) as infd:
+            read = infd.read
+            chunk = read(chunk_size)
+            while chunk:
+                yield chunk
+                chunk = read(chunk_size)
+    except OSError as err:
+        error_frame('Problem reading from file')
+        error('OSError({0}): {1}'.format(err.errno, err.strerror))
+
+
 def objectify_write(path_buf_stream,
                     buf,
                     as_json=False,
@@ -1,15 +1,19 @@
 """Provide a clean, simple but flexible way to load JSON and JSON-lines files
 
 To write JSON, use objectify_write with as_json=True
+To write JSON lines one object at a time, use objectify_write_json_lines
 
 """
 from io import StringIO
 
-from ujson import loads, load
+from ujson import loads, load, dumps
 from json import JSONDecodeError
 
 from objectify.log import error
 from objectify.encoding import _DEFAULT_ENCODING
+from objectify.io import (
+    _WRITE_BUFFER_SIZE,
+    _open_write)
 
 
 def objectify_json(path_buf_stream,
@@ -17,17 +21,21 @@ def objectify_json(path_buf_stream,
                    from_string=False,
                    ensure_ascii=False,
                    encode_html_chars=False):
-    """Return a native Python object from a JSON file path, stream or string"""
+    """Return a native Python object from a JSON file path, stream or string
+
+    ensure_ascii and encode_html_chars only apply when encoding JSON, they
+    are accepted for compatibility and otherwise ignored
+    """
     if from_string is True:
-        path_buf_stream = StringIO(path_buf_stream)
+        return loads(path_buf_stream)
 
     read = getattr(path_buf_stream, 'read', None)
 
     if read is not None:
-        return load(read(), ensure_ascii=ensure_ascii, encode_html_chars=encode_html_chars)
+        return loads(read())
     with open(path_buf_stream, encoding=encoding) as infd:
         try:
-            return load(infd, ensure_ascii=ensure_ascii, encode_html_chars=encode_html_chars)
+            return load(infd)
         except Exception as err:
             error(repr(err))
 
@@ -95,8 +103,12 @@ def objectify_json_lines(path_buf_stream,
                     continue
             return obj_list
 
-        for line in infd.readlines():
+        # Iterate the stream directly rather than using readlines(), which
+        # would pull the entire file into memory before the first object
+        for line in infd:
             line = line.strip()
+            if not line:
+                continue
             # Exception handlers are expensive to set up and even more expensive
             # when they fire. If errors should be fatal, don't bother setting one
             # up at all
@@ -110,3 +122,42 @@ def objectify_json_lines(path_buf_stream,
                 except Exception as err:
                     error('bad JSON-line line: {}'.format(repr(err)))
                     continue
+
+
+def objectify_write_json_lines(path_buf_stream,
+                               objs,
+                               encoding=_DEFAULT_ENCODING,
+                               ensure_ascii=True,
+                               buffering=_WRITE_BUFFER_SIZE,
+                               compress=None,
+                               serialized=False):
+    """Write each object from an iterable as a line of JSON to a file or stream
+
+    path_buf_stream: can be a writable stream-like object or a file path
+
+    Objects are serialized and written one at a time, so `objs` can be a
+    generator such as the one returned by objectify_json_lines or objectify_csv
+    and memory usage stays bounded regardless of the number of objects. When a
+    file path is given, it is opened with a large write buffer and compressed
+    if the path ends with .gz, .bz2 or .xz, or if `compress` names one of
+    'gzip', 'bz2' or 'xz'
+
+    Non-ASCII characters are escaped by default, as the output is opened with
+    `encoding`, which may not be able to represent them. Set
+    `ensure_ascii=False` to write them as they are, with an encoding such as
+    'utf-8' that can
+
+    Set `serialized=True` if each object is already a string of JSON
+
+    Returns the number of objects written
+    """
+    writer = getattr(path_buf_stream, 'write', None)
+    count = 0
+    with (path_buf_stream if writer else _open_write(
+            path_buf_stream, encoding=encoding, compress=compress, buffering=buffering)) as outfd:
+        write = outfd.write
+        for obj in objs:
+            write(obj if serialized is True else dumps(obj, ensure_ascii=ensure_ascii))
+            write('\n')
+            count += 1
+    return count
@@ -0,0 +1,24 @@
+"""Helpers for handing work to a pool of threads or processes"""
+from collections import deque
+from os import cpu_count
+
+
+def _pool_size(workers):
+    """Return how many workers a pool started with max_workers=workers has"""
+    return workers or cpu_count() or 1
+
+
+def _submit_bounded(pool, func, jobs, max_pending, *args):
+    """Generator submitting func(job, *args) to pool for each job, in order
+
+    Returns (job, future) pairs in the order the jobs were given. At most
+    max_pending jobs are submitted and not yet returned, so jobs can be a
+    generator over more work than fits in memory
+    """
+    pending = deque()
+    for job in jobs:
+        pending.append((job, pool.submit(func, job, *args)))
+        if len(pending) >= max_pending:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
@@ -1,10 +1,582 @@
 """Provide templating functionality for use in YaML loading"""
 
+import re
+from collections import OrderedDict
+from collections.abc import Mapping
+from functools import lru_cache
 from os.path import expanduser
-from jinja2 import Template
+from jinja2 import Environment, meta, nodes
 
 from objectify.log import error_frame
 
+# How many compiled templates to keep around
+TEMPLATE_CACHE_SIZE = 4096
+
+# Marks a variable that can't be looked up without Jinja2
+_MISSING = object()
+
+# One Environment shared by every template, with the same defaults Template() uses
+_ENVIRONMENT = Environment()
+
+# A plain variable or dotted key path, e.g. {{ root }} or {{ db.primary.host }}
+_SIMPLE_VARIABLE = re.compile(
+    r'\{\{\s*([A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*)\s*\}\}')
+
+# Names Jinja2 parses as constants or operators rather than variables
+_RESERVED_NAMES = frozenset((
+    'true', 'false', 'none', 'True', 'False', 'None',
+    'and', 'or', 'not', 'in', 'is', 'if', 'else'))
+
+
+def _is_literal(data):
+    """Return True if a string has no Jinja2 markers, so rendering is a no-op
+
+    A '\r' is treated as a marker too, Jinja2 normalizes line endings and
+    the result would not be identical otherwise
+    """
+    if '\r' in data:
+        return False
+    return '{' not in data or not ('{{' in data or '{%' in data or '{#' in data)
+
+
+def _render_literal(data):
+    """Return what Jinja2 would render for a string with no markers
+
+    The only difference Jinja2 makes is to drop a single trailing newline
+    """
+    if data.endswith('\n'):
+        return data[:-1]
+    return data
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _compile_template(source):
+    """Return the compiled Template for a string, compiling it only once
+
+    Compiling a template to Python bytecode costs far more than rendering
+    it, and the same strings are rendered over and over, on each templating
+    pass and for values that repeat throughout a document
+    """
+    return _ENVIRONMENT.from_string(source)
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _compile_native(source):
+    """Split a template made only of plain variables into text and key paths
+
+    Returns (texts, paths) where the output is texts[0], then the value of
+    paths[0] followed by texts[1] and so on, or None if the template uses
+    anything else (filters, tests, expressions, blocks or comments) and
+    has to be rendered by Jinja2
+    """
+    if '\r' in source:
+        return None
+    texts = []
+    paths = []
+    start = 0
+    for match in _SIMPLE_VARIABLE.finditer(source):
+        texts.append(source[start:match.start()])
+        path = tuple(match.group(1).split('.'))
+        if path[0] in _RESERVED_NAMES:
+            return None
+        paths.append(path)
+        start = match.end()
+    texts.append(source[start:])
+    for text in texts:
+        if '{{' in text or '{%' in text or '{#' in text:
+            return None
+    # A '{' right before a variable would be read by Jinja2 as part of it
+    for text in texts[:-1]:
+        if text.endswith('{'):
+            return None
+    if texts[-1].endswith('\n'):
+        texts[-1] = texts[-1][:-1]
+    return tuple(texts), tuple(paths)
+
+
+def _render(source, template_vars):
+    """Render a template string, without Jinja2 if it only uses plain variables
+
+    Each key path is looked up with plain dict lookups. Anything Jinja2
+    would resolve differently, such as a missing key or a key that is also
+    a dict attribute like `items`, is left to Jinja2 so the output is the
+    same either way
+    """
+    native = _compile_native(source)
+    if native is not None:
+        texts, paths = native
+        pieces = [texts[0]]
+        for path, text in zip(paths, texts[1:]):
+            value = template_vars.get(path[0], _MISSING)
+            for key in path[1:]:
+                if not isinstance(value, dict) or key not in value or hasattr(value, key):
+                    value = _MISSING
+                    break
+                value = value[key]
+            if value is _MISSING:
+                break
+            pieces.append(value if isinstance(value, str) else str(value))
+            pieces.append(text)
+        else:
+            return ''.join(pieces)
+    return _compile_template(source).render(template_vars)
+
+
+def _reference_paths(node, names, paths):
+    """Add the key path of each variable in names used under a Jinja2 node
+
+    `db.primary.host`, `db['primary'].host` and `hosts[0]` become
+    ('db', 'primary', 'host') and ('hosts', 0). A subscript that is not a
+    constant ends the path, the path up to it is used instead
+    """
+    path = []
+    while isinstance(node, (nodes.Getattr, nodes.Getitem)):
+        if isinstance(node, nodes.Getattr):
+            path.append(node.attr)
+        elif isinstance(node.arg, nodes.Const):
+            path.append(node.arg.value)
+        else:
+            _reference_paths(node.arg, names, paths)
+            path = []
+        node = node.node
+    if isinstance(node, nodes.Name):
+        if node.name in names:
+            path.append(node.name)
+            paths.add(tuple(reversed(path)))
+        return
+    for child in node.iter_child_nodes():
+        _reference_paths(child, names, paths)
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _template_references(source):
+    """Return the key paths of the variables a template string refers to"""
+    ast = _ENVIRONMENT.parse(source)
+    paths = set()
+    _reference_paths(ast, meta.find_undeclared_variables(ast), paths)
+    return frozenset(paths)
+
+
+def template_variables(data):
+    """Return the names of the variables referenced anywhere in data
+
+    Only the first part of a name is returned, e.g. 'db' for '{{ db.host }}'
+    """
+    names = set()
+    seen = set()
+    stack = [data]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            if not _is_literal(item):
+                names.update(path[0] for path in _template_references(item))
+        elif isinstance(item, (dict, list)) and id(item) not in seen:
+            seen.add(id(item))
+            stack.extend(item.values() if isinstance(item, dict) else item)
+    return names
+
+
+def _path_index(data):
+    """Return a flat dict of key path to (container, key) for every value in data
+
+    Paths are tuples of keys and list indexes, e.g. ('db', 'hosts', 0). A
+    dict or list that appears more than once, like a YaML anchor and its
+    aliases, only has the values inside it indexed under the first path it
+    is found at. Returns the index and a dict of id() to that first path
+    """
+    index = {}
+    canonical = {id(data): ()}
+    stack = [((), data)]
+    while stack:
+        prefix, container = stack.pop()
+        items = container.items() if isinstance(container, dict) else enumerate(container)
+        for key, value in items:
+            path = prefix + (key,)
+            index[path] = (container, key)
+            if isinstance(value, (dict, list)) and id(value) not in canonical:
+                canonical[id(value)] = path
+                stack.append((path, value))
+    return index, canonical
+
+
+def _path_name(path):
+    """Return a key path as it would be written in a template"""
+    return '.'.join(str(key) for key in path)
+
+
+def _dependency_order(deps, roots=None, state=None):
+    """Return the keys of deps so that each comes after every key it depends on
+
+    deps maps each key path to the key paths it refers to. A RuntimeError
+    naming the keys involved is raised if there is a cycle
+
+    Only roots and what they depend on are ordered, by default every key of
+    deps. state can be kept between calls, keys ordered by an earlier call
+    are not returned again
+    """
+    order = []
+    # 1 while a key's dependencies are being visited, 2 once it is in order
+    if state is None:
+        state = {}
+    for root in (deps if roots is None else roots):
+        if root in state:
+            continue
+        state[root] = 1
+        path = [root]
+        pending = [iter(deps[root])]
+        while pending:
+            for dep in pending[-1]:
+                if dep not in state:
+                    state[dep] = 1
+                    path.append(dep)
+                    pending.append(iter(deps[dep]))
+                    break
+                if state[dep] == 1:
+                    cycle = [_path_name(key) for key in path[path.index(dep):] + [dep]]
+                    for key in path:
+                        del state[key]
+                    error_frame('cycle in template references: {}'.format(' -> '.join(cycle)))
+                    raise RuntimeError('unable to template keys {}'.format(', '.join(cycle[:-1])))
+            else:
+                pending.pop()
+                key = path.pop()
+                state[key] = 2
+                order.append(key)
+    return order
+
+
+def _path_deps(path, index, canonical, template_vars):
+    """Return the key paths the value at path depends on
+
+    A dict or list depends on each of its items, or on the first path it is
+    found at if it appears more than once. A templated string depends on
+    each value it refers to that is in the index and not in template_vars
+    """
+    container, key = index[path]
+    value = container[key]
+    if isinstance(value, (dict, list)) and canonical[id(value)] != path:
+        return [canonical[id(value)]]
+    if isinstance(value, dict):
+        return [path + (child,) for child in value]
+    if isinstance(value, list):
+        return [path + (child,) for child in range(len(value))]
+    if isinstance(value, str) and not _is_literal(value):
+        refs = []
+        for ref in _template_references(value):
+            if ref[0] in template_vars:
+                continue
+            # A reference past the end of a path, e.g. to a method of a
+            # string, depends on the longest path that does exist
+            while ref and ref not in index:
+                ref = ref[:-1]
+            if ref:
+                refs.append(ref)
+        return refs
+    return ()
+
+
+def _reference_deps(index, canonical, template_vars):
+    """Return a dict of key path to the key paths it depends on"""
+    return {path: _path_deps(path, index, canonical, template_vars) for path in index}
+
+
+class _LazyDeps(dict):
+    """_reference_deps() that only works out the paths that are asked for"""
+
+    def __init__(self, index, canonical, template_vars):
+        super().__init__()
+        self.index = index
+        self.canonical = canonical
+        self.template_vars = template_vars
+
+    def __missing__(self, path):
+        deps = self[path] = _path_deps(path, self.index, self.canonical, self.template_vars)
+        return deps
+
+
+def ordered_template(data, template_vars=None):
+    """Template a dict whose values refer to each other, in a single pass
+
+    The variables referenced by each value, including nested keys and list
+    indexes such as `db.primary.host` or `hosts[0]`, are looked up in a flat
+    index of every key path in data. Values are then rendered in an order
+    where each comes after the values it refers to, so chains of references
+    of any length and depth are resolved in one render per value. Variables
+    in template_vars take precedence over the keys in data. As with
+    recursive_template(), each string is passed through expanduser
+
+    A RuntimeError is raised if values refer to each other in a cycle
+    """
+    if template_vars is None:
+        template_vars = {}
+    elif not isinstance(template_vars, dict):
+        raise RuntimeError('template_vars must be an instance of dict()')
+
+    if template_vars:
+        context = dict(data)
+        context.update(template_vars)
+    else:
+        context = data
+
+    index, canonical = _path_index(data)
+    deps = _reference_deps(index, canonical, template_vars)
+    _render_paths(_dependency_order(deps), index, context, template_vars)
+    return data
+
+
+def _render_paths(paths, index, context, template_vars):
+    """Render the strings at paths in place, in that order
+
+    Top-level values are also updated in context, unless template_vars
+    overrides them
+    """
+    for path in paths:
+        container, key = index[path]
+        value = container[key]
+        if not isinstance(value, str):
+            continue
+        container[key] = recursive_template(value, context)
+        if len(path) == 1 and key not in template_vars:
+            context[key] = container[key]
+
+
+def _copy_containers(data):
+    """Return a copy of data with new dicts and lists, sharing the scalars
+
+    A dict or list that appears more than once is copied once, and that
+    copy appears in the same places
+    """
+    copied = type(data)() if isinstance(data, dict) else []
+    copies = {id(data): copied}
+    stack = [(data, copied)]
+    while stack:
+        source, target = stack.pop()
+        items = source.items() if isinstance(source, dict) else enumerate(source)
+        for key, value in items:
+            if isinstance(value, (dict, list)):
+                if id(value) in copies:
+                    value = copies[id(value)]
+                else:
+                    value_copy = type(value)() if isinstance(value, dict) else []
+                    copies[id(value)] = value_copy
+                    stack.append((value, value_copy))
+                    value = value_copy
+            if isinstance(target, dict):
+                target[key] = value
+            else:
+                target.append(value)
+    return copied
+
+
+class _BatchTemplate():
+    """A self-templating dict, rendered once against many sets of variables
+
+    The references between values are worked out once and the document is
+    rendered once without any variables. Rendering it for a set of variables
+    then copies that result and renders again only the values that refer,
+    directly or through other values, to a name in the set. The result is
+    the same as ordered_template() on a fresh copy of the document
+    """
+
+    def __init__(self, data):
+        if not isinstance(data, dict):
+            raise RuntimeError('only a dict can be templated in dependency order')
+        index, canonical = _path_index(data)
+        deps = _reference_deps(index, canonical, {})
+        self.order = {}
+        # Every name each value refers to, directly or through other values
+        roots = {}
+        # Why a value could not be rendered without variables, if it wasn't
+        self.errors = {}
+        # The original text of each templated string, to render it again
+        self.sources = {}
+        for path in _dependency_order(deps):
+            container, key = index[path]
+            value = container[key]
+            names = set()
+            for dep in deps[path]:
+                names |= roots[dep]
+                if dep in self.errors and path not in self.errors:
+                    self.errors[path] = self.errors[dep]
+            if isinstance(value, str):
+                self.order[path] = len(self.order)
+                if not _is_literal(value):
+                    names.update(ref[0] for ref in _template_references(value))
+                    self.sources[path] = value
+                if path not in self.errors:
+                    try:
+                        container[key] = recursive_template(value, data)
+                    except Exception as err:
+                        self.errors[path] = err
+            roots[path] = names
+        self.dependents = {}
+        for path in self.sources:
+            for name in roots[path]:
+                self.dependents.setdefault(name, []).append(path)
+        self.data = data
+
+    def render(self, template_vars):
+        """Return a new copy of the document rendered with template_vars"""
+        if not isinstance(template_vars, dict):
+            raise RuntimeError('template_vars must be an instance of dict()')
+        stale = set()
+        for name in template_vars:
+            stale.update(self.dependents.get(name, ()))
+        for path, err in self.errors.items():
+            if path in self.order and path not in stale:
+                raise err
+        data = _copy_containers(self.data)
+        context = dict(data)
+        context.update(template_vars)
+        for path in sorted(stale, key=self.order.__getitem__):
+            container = data
+            for key in path[:-1]:
+                container = container[key]
+            key = path[-1]
+            container[key] = recursive_template(self.sources[path], context)
+            if len(path) == 1 and key not in template_vars:
+                context[key] = container[key]
+        return data
+
+
+class LazyTemplate(Mapping):
+    """A read-only view of a self-templating dict that renders on access
+
+    Each top-level value is rendered the first time it is read, and kept
+    for later reads. The values it refers to, including nested keys and list
+    indexes such as `paths.root`, are rendered first in the same order as
+    ordered_template(), so a value may refer to other values under the same
+    key. Only the values that are read, and the ones they refer to, are
+    ever rendered. Variables in template_vars take precedence over the keys
+    in data. Like ordered_template(), data is templated in place
+
+    Call materialize() to render everything and get a plain OrderedDict. A
+    RuntimeError is raised on reading a value that refers to itself, directly
+    or through other values
+    """
+
+    def __init__(self, data, template_vars=None):
+        if template_vars is None:
+            template_vars = {}
+        elif not isinstance(template_vars, dict):
+            raise RuntimeError('template_vars must be an instance of dict()')
+        if template_vars:
+            self._context = dict(data)
+            self._context.update(template_vars)
+        else:
+            self._context = data
+        self._data = data
+        self._template_vars = template_vars
+        self._index, canonical = _path_index(data)
+        self._deps = _LazyDeps(self._index, canonical, template_vars)
+        # The _dependency_order() state of each path seen so far
+        self._state = {}
+
+    def __getitem__(self, key):
+        if key not in self._data:
+            raise KeyError(key)
+        if self._state.get((key,)) != 2:
+            order = _dependency_order(self._deps, roots=[(key,)], state=self._state)
+            for done, path in enumerate(order):
+                try:
+                    _render_paths((path,), self._index, self._context, self._template_vars)
+                except Exception:
+                    # Nothing from here on was rendered, try again on the next read
+                    for pending in order[done:]:
+                        del self._state[pending]
+                    raise
+        return self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        rendered = sum(1 for key in self._data if self._state.get((key,)) == 2)
+        return '{}({} of {} rendered)'.format(type(self).__name__, rendered, len(self._data))
+
+    def materialize(self):
+        """Render every value and return them all as an OrderedDict"""
+        return OrderedDict((key, self[key]) for key in self._data)
+
+
+def _pending_strings(data):
+    """Return (container, key) for each string in data, in the order
+    recursive_template() visits them. Like recursive_template(), a dict or
+    list that appears more than once is only visited the first time"""
+    pending = []
+    stack = [iter(data.items())]
+    containers = [data]
+    seen = {id(data)}
+    while stack:
+        for key, value in stack[-1]:
+            if isinstance(value, str):
+                pending.append((containers[-1], key))
+            elif isinstance(value, (dict, list)) and id(value) in seen:
+                continue
+            elif isinstance(value, dict):
+                seen.add(id(value))
+                containers.append(value)
+                stack.append(iter(value.items()))
+                break
+            elif isinstance(value, list):
+                seen.add(id(value))
+                containers.append(value)
+                stack.append(enumerate(value))
+                break
+        else:
+            stack.pop()
+            containers.pop()
+    return pending
+
+
+def _is_settled(data):
+    """Return True if templating a string again would leave it as it is"""
+    return _is_literal(data) and not data.endswith('\n') and not data.startswith('~')
+
+
+def template_passes(data, passes):
+    """Self-template a dict in place up to `passes` times, stopping early once
+    a pass leaves every value as it was
+
+    Each pass renders the values in the same order as recursive_template(),
+    against the document as it is being updated, so the result is the same
+    as making every pass. Values that no longer contain template markers are
+    not visited again by later passes
+
+    Returns the templated data and the amount of passes that were made
+    """
+    if passes > 0 and not isinstance(data, dict):
+        raise RuntimeError('template_vars must be an instance of dict()')
+
+    pending = [leaf for leaf in _pending_strings(data) if not _is_settled(leaf[0][leaf[1]])]
+    for used in range(passes):
+        if not pending:
+            return data, used
+        changed = False
+        unsettled = []
+        for container, key in pending:
+            value = container[key]
+            if _is_literal(value):
+                templated = _render_literal(value)
+            else:
+                templated = _render(value, data)
+            templated = expanduser(templated)
+            if templated != value:
+                container[key] = templated
+                changed = True
+            if not _is_settled(templated):
+                unsettled.append((container, key))
+        if changed is False:
+            return data, used + 1
+        pending = unsettled
+    return data, passes
+
 
 def _recursive_template(data, template_vars=None, user_path_expand=True):
     """data is an arbitrary data structure, template_vars is a dict
@@ -28,8 +600,10 @@ def _recursive_template(data, template_vars=None, user_path_expand=True):
 
     def _handle_str(data, template_vars):
         """Handle a simple string value"""
-        tmpl = Template(data)
-        data = tmpl.render(template_vars)
+        if _is_literal(data):
+            data = _render_literal(data)
+        else:
+            data = _render(data, template_vars)
         if user_path_expand is True:
             data = expanduser(data)
         return data
@@ -69,74 +643,85 @@ def _recursive_template(data, template_vars=None, user_path_expand=True):
     raise RuntimeError('unable to template object')
 
 
-def recursive_template(data, template_vars=None, user_path_expand=True):
+def recursive_template(data, template_vars=None, user_path_expand=True, copy=False):
     """data is an arbitrary data structure, template_vars is a dict
 
     The `data` object is traversed and each instance of a Jinja2 variable
     that is found in template_vars is replaced (templated)
 
-    This is a recursive function with the end-case being when the object is
-    a simple string or unicode string type
-    """
-    # These conditionals can be cleaned up a little bit
-    # Note there is no use for `elif` because each block returns making
-    # the `else` implied
-    # def _handle_list(data, template_vars):
-    #     tmp_list = []
-    #     data.reverse()
-    #     while data:
-    #         item = data.pop()
-    #         item = recursive_template(item, template_vars)
-    #         tmp_list.append(item)
-    #     return tmp_list
-
-    # def _handle_str(data, template_vars, user_path_expand=user_path_expand):
-    #     tmpl = Template(data)
-    #     data = tmpl.render(template_vars)
-    #     if user_path_expand is True:
-    #         data = expanduser(data)
-    #     return data
-
-    # def _handle_numeric(data):
-    #     return data
-
-    # def _handle_dict(data, template_vars):
-    #     if isinstance(data, dict):
-    #         for key, value in data.items():
-    #             data[key] = recursive_template(value, template_vars)
-    #         return data
+    Dicts and lists are templated in place and returned. Set `copy=True` to
+    leave data as it is and get new dicts and lists instead. Tuples are
+    returned as new tuples either way. Bools, numbers and None are returned
+    as they are
 
+    The traversal keeps its own stack rather than recursing, so there is no
+    limit on how deeply data can be nested. A dict, list or tuple that
+    appears more than once, such as a YaML anchor and its aliases, is
+    templated once and the result appears in each place it did before
+
+    user_path_expand only applies when data is itself a string. Strings in
+    dicts, lists and tuples are always passed through expanduser
+    """
     if template_vars is None:
         template_vars = {}
 
     elif not isinstance(template_vars, dict):
         raise RuntimeError('template_vars must be an instance of dict()')
 
-    if isinstance(data, str):
-        tmpl = Template(data)
-        data = tmpl.render(template_vars)
-        if user_path_expand is True:
-            data = expanduser(data)
-        return data
+    def _template_scalar(value, expand=True):
+        """Template a single value that is not a container"""
+        if isinstance(value, str):
+            if _is_literal(value):
+                value = _render_literal(value)
+            else:
+                value = _render(value, template_vars)
+            if expand is True:
+                value = expanduser(value)
+            return value
+        if value is None or isinstance(value, (int, float)):
+            return value
+        error_frame('unexpected and unsupported type "{}" encountered'.format(
+            type(value)))
+        raise RuntimeError('unable to template object')
 
-    if isinstance(data, dict):
-        for key, value in data.items():
-            data[key] = recursive_template(value, template_vars)
-        return data
+    # id() of each container visited so far to what it was templated to
+    templated = {}
 
-    if isinstance(data, list):
-        # Not supporting sets and tuples since YaML doesn't support them
-        tmp_list = []
-        data.reverse()
-        while data:
-            item = data.pop()
-            item = recursive_template(item, template_vars)
-            tmp_list.append(item)
-        return tmp_list
+    def _frame(value, parent, key):
+        """Start templating a container, returns its stack frame"""
+        if isinstance(value, dict):
+            target = type(value)() if copy is True else value
+            items = iter(value.items())
+        elif isinstance(value, list) and copy is False:
+            target = value
+            items = enumerate(value)
+        else:
+            target = list(value)
+            items = enumerate(target)
+        if not isinstance(value, tuple):
+            templated[id(value)] = target
+        return [value, target, items, parent, key]
 
-    if isinstance(data, (int, float)):
-        return data
+    if not isinstance(data, (dict, list, tuple)):
+        return _template_scalar(data, expand=user_path_expand)
 
-    error_frame('unexpected and unsupported type "{}" encountered'.format(
-        type(data)))
-    raise RuntimeError('unable to template object')
+    stack = [_frame(data, None, None)]
+    while stack:
+        frame = stack[-1]
+        source, target, items = frame[:3]
+        for key, value in items:
+            if isinstance(value, (dict, list, tuple)):
+                if id(value) in templated:
+                    target[key] = templated[id(value)]
+                    continue
+                stack.append(_frame(value, target, key))
+                break
+            target[key] = _template_scalar(value)
+        else:
+            stack.pop()
+            result = target
+            if isinstance(source, tuple):
+                result = templated[id(source)] = tuple(target)
+            if not stack:
+                return result
+            frame[3][frame[4]] = result
@@ -14,64 +14,98 @@ Useful for:
   - Working with XML data usng Python native types, directly
   - Converting an XML stream into a JSON stream
 
-Beware of memory pressure on extremely large XML files!
+Beware of memory pressure on extremely large XML files! For files made up of
+many repeated records, use objectify_xml_records to stream one record at a
+time instead
 
 There is a very basic improvement that needs to be done here, but it is a
 mindfck to do ... so it will wait for now
 """
-from sys import argv
+import re
+from codecs import (
+    BOM_UTF8,
+    BOM_UTF16_BE,
+    BOM_UTF16_LE,
+    getincrementaldecoder)
+from sys import argv, intern
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from io import StringIO
 import xml.etree.cElementTree as ET
+from xml.parsers.expat import ParserCreate
 
+from ujson import dumps
+
+from objectify.encoding import _DEFAULT_ENCODING
 from objectify.io import (
+    _READ_CHUNK_SIZE,
     objectify_read,
+    objectify_read_chunks,
     objectify_write)
+from objectify.pool import _pool_size, _submit_bounded
 
 
-def _elem_to_internal(element,
-                      strip_ns=True,
-                      strip_whitespace=True,
-                      skip_tails=('#', ),
-                      skip_text=('\n', )):
-    """Convert an Element into a native Python dictionary"""
-    def _strip_tag(tag):
-        """Strip a tag out of brackets"""
-        strip_ns_tag = tag
-        split_array = tag.split('}')
-        if len(split_array) > 1:
-            strip_ns_tag = split_array[1]
-            tag = strip_ns_tag
-        return tag
-
-    cur_dict = OrderedDict()
-    elem_tag = element.tag
-    if strip_ns is True:
-        elem_tag = _strip_tag(element.tag)
-    for key, value in list(element.attrib.items()):
-        cur_dict['@' + key] = value
-
-    # Merge sub-elements
-    for sub_element in element:
-        cur_val = _elem_to_internal(
-            sub_element, strip_ns=strip_ns, strip_whitespace=strip_whitespace)
-
-        tag = sub_element.tag
-        if strip_ns is True:
-            tag = _strip_tag(sub_element.tag)
-
-        value = cur_val[tag]
-
-        try:
-            # add to existing list for this tag
-            cur_dict[tag].append(value)
-        except AttributeError:
-            # turn existing entry into a list
-            cur_dict[tag] = [cur_dict[tag], value]
-        except KeyError:
-            # add a new non-list entry
-            cur_dict[tag] = value
-    text = element.text
-    tail = element.tail
+def _strip_tag(tag):
+    """Strip a tag out of brackets"""
+    strip_ns_tag = tag
+    split_array = tag.split('}')
+    if len(split_array) > 1:
+        strip_ns_tag = split_array[1]
+        tag = strip_ns_tag
+    return tag
+
+
+class _TagNames(dict):
+    """Map each raw tag to its output key
+
+    The namespace is stripped (if requested) and the result interned only
+    the first time a tag is seen, after that it is a single dict lookup.
+    Every element with the same tag shares the same key string
+    """
+    def __init__(self, strip_ns=True):
+        super().__init__()
+        self.strip_ns = strip_ns
+
+    def __missing__(self, tag):
+        name = intern(_strip_tag(tag) if self.strip_ns is True else tag)
+        self[tag] = name
+        return name
+
+
+class _AttrNames(dict):
+    """Map each raw attribute name to its interned '@name' output key"""
+    def __missing__(self, key):
+        name = intern('@' + key)
+        self[key] = name
+        return name
+
+
+class _ExpatTagNames(_TagNames):
+    """_TagNames for expat, which reports namespaced tags as 'namespace}tag'"""
+    def __missing__(self, tag):
+        if '}' in tag and self.strip_ns is not True:
+            # Match ElementTree, which uses '{namespace}tag'
+            name = intern('{' + tag)
+            self[tag] = name
+            return name
+        return super().__missing__(tag)
+
+
+class _ExpatAttrNames(_AttrNames):
+    """_AttrNames for expat, which reports namespaced names as 'namespace}name'"""
+    def __missing__(self, key):
+        if '}' in key:
+            name = intern('@{' + key)
+            self[key] = name
+            return name
+        return super().__missing__(key)
+
+
+def _finish_value(cur_dict, text, tail, strip_whitespace, skip_tails, skip_text):
+    """Add the text and tail of a completed element, return its value
+
+    cur_dict already holds the attributes and children of the element
+    """
     if strip_whitespace is True:
         # Remove whitespace from both ends
         if text:
@@ -88,27 +122,744 @@ def _elem_to_internal(element,
         # is not a blacklisted value
         if text and text not in skip_text:
             cur_dict["#text"] = text
+        return cur_dict
+    # Text is the value if no attributes
+    return text or None
+
+
+def _force_list_tags(force_list):
+    """Return force_list as a frozenset of tags, a single tag may be a str"""
+    if isinstance(force_list, str):
+        return frozenset((force_list, ))
+    return frozenset(force_list or ())
+
+
+def _merge_value(cur_dict, tag, value, force_list=frozenset()):
+    """Add a child value to its parent dict, building a list on repeated tags
+
+    Tags in force_list always get a list, even when they appear only once.
+    This is all done with membership tests rather than by catching
+    exceptions, which would otherwise fire for nearly every element
+    """
+    if tag in cur_dict:
+        existing = cur_dict[tag]
+        if type(existing) is list:
+            # add to existing list for this tag
+            existing.append(value)
+        else:
+            # turn existing entry into a list
+            cur_dict[tag] = [existing, value]
+    elif tag in force_list:
+        cur_dict[tag] = [value]
     else:
-        # Text is the value if no attributes
-        cur_dict = text or None
-    return {elem_tag: cur_dict}
+        # add a new non-list entry
+        cur_dict[tag] = value
+
+
+def _repeated_tags(elements, tag_names):
+    """Return the tags that appear more than once under the same parent
+
+    This is the first pass of force_list='auto', elements is an iterable
+    of Elements to learn from, e.g. a document root or a sample of records
+    """
+    repeated = set()
+    for element in elements:
+        for parent in element.iter():
+            seen = set()
+            for child in parent:
+                tag = tag_names[child.tag]
+                if tag in seen:
+                    repeated.add(tag)
+                else:
+                    seen.add(tag)
+    return frozenset(repeated)
+
+
+def _elem_to_internal(element,
+                      strip_ns=True,
+                      strip_whitespace=True,
+                      skip_tails=('#', ),
+                      skip_text=('\n', ),
+                      force_list=frozenset(),
+                      compact=False,
+                      tag_names=None,
+                      attr_names=None):
+    """Convert an Element into a native Python dictionary
+
+    Children with a tag in force_list are always put in a list
+
+    Set compact=True to use plain dicts, which keep insertion order anyway
+    and take roughly half the memory of an OrderedDict. To share key strings
+    across calls, e.g. one call per record, pass in the same _TagNames and
+    _AttrNames each time
+
+    The tree is walked depth-first with an explicit stack rather than by
+    recursing, so very deep documents can't hit the recursion limit. Each
+    completed child value is merged directly into its parent's dict instead
+    of being wrapped in a temporary {tag: value} dict, and childless elements
+    (most of them, in a wide document) are converted without ever being
+    pushed onto the stack
+    """
+    if tag_names is None:
+        tag_names = _TagNames(strip_ns)
+    if attr_names is None:
+        attr_names = _AttrNames()
+    dict_type = dict if compact is True else OrderedDict
+
+    def _new_dict(element):
+        """Return a new dict holding the attributes of an element"""
+        cur_dict = dict_type()
+        for key, value in element.attrib.items():
+            cur_dict[attr_names[key]] = value
+        return cur_dict
+
+    root_tag = tag_names[element.tag]
+
+    # Each entry is (element, its tag, iterator over its children, its dict)
+    stack = [(element, root_tag, iter(element), _new_dict(element))]
+    while stack:
+        elem, tag, children, cur_dict = stack[-1]
+        for sub_element in children:
+            sub_tag = tag_names[sub_element.tag]
+            if len(sub_element):
+                # Descend, this element is picked up again once the child is done
+                stack.append((sub_element, sub_tag, iter(sub_element), _new_dict(sub_element)))
+                break
+            # A childless element can be finished right away
+            value = _finish_value(_new_dict(sub_element), sub_element.text, sub_element.tail,
+                                  strip_whitespace, skip_tails, skip_text)
+            _merge_value(cur_dict, sub_tag, value, force_list)
+        else:
+            # All children are merged, finish this element
+            stack.pop()
+            value = _finish_value(cur_dict, elem.text, elem.tail,
+                                  strip_whitespace, skip_tails, skip_text)
+            if not stack:
+                return {tag: value}
+            _merge_value(stack[-1][3], tag, value, force_list)
+
+
+def _expat_to_internal(chunks,
+                       strip_ns=True,
+                       strip_whitespace=True,
+                       skip_tails=('#', ),
+                       skip_text=('\n', ),
+                       force_list=frozenset(),
+                       compact=False):
+    """Convert XML into a native Python dictionary using expat
+
+    chunks is an iterable of str or bytes, e.g. from objectify_read_chunks,
+    that is fed to the parser one at a time
+
+    Produces exactly what _elem_to_internal produces for the same document,
+    but builds the dicts directly from the expat callbacks in a single pass,
+    without ever creating an ElementTree
+
+    The only tricky part is the tail, the text following the end tag of an
+    element. It is part of that element's value, so a closed element is kept
+    as `pending` until the next tag in its parent shows up, at which point
+    the tail is complete and the value can be finished and merged
+    """
+    tag_names = _ExpatTagNames(strip_ns)
+    attr_names = _ExpatAttrNames()
+    dict_type = dict if compact is True else OrderedDict
+
+    # Each open element is (tag, dict, text chunks)
+    stack = []
+    # The most recently closed element not yet merged: (tag, dict, text chunks, tail chunks)
+    pending = None
+    result = {}
+
+    def _merge_pending():
+        """Finish the pending element now that its tail is complete"""
+        nonlocal pending
+        tag, cur_dict, text, tail = pending
+        pending = None
+        value = _finish_value(cur_dict, ''.join(text), ''.join(tail),
+                              strip_whitespace, skip_tails, skip_text)
+        if stack:
+            _merge_value(stack[-1][1], tag, value, force_list)
+        else:
+            result[tag] = value
+
+    def _start(tag, attrs):
+        """Open a new element, finishing the previous sibling first"""
+        if pending is not None:
+            _merge_pending()
+        cur_dict = dict_type()
+        if attrs:
+            # ordered_attributes is set, attrs is [name, value, name, value, ...]
+            for key, value in zip(attrs[::2], attrs[1::2]):
+                cur_dict[attr_names[key]] = value
+        stack.append((tag_names[tag], cur_dict, []))
+
+    def _end(_tag):
+        """Close an element, it stays pending until its tail is known"""
+        nonlocal pending
+        if pending is not None:
+            _merge_pending()
+        pending = stack.pop() + ([], )
+
+    def _data(data):
+        """Text goes to the tail of the pending element, else the open one"""
+        if pending is not None:
+            pending[3].append(data)
+        elif stack:
+            stack[-1][2].append(data)
+
+    parser = ParserCreate(namespace_separator='}')
+    parser.ordered_attributes = True
+    parser.buffer_text = True
+    parser.StartElementHandler = _start
+    parser.EndElementHandler = _end
+    parser.CharacterDataHandler = _data
+    for chunk in chunks:
+        parser.Parse(chunk, False)
+    parser.Parse('', True)
+    if pending is not None:
+        # The root element has no tail
+        del pending[3][:]
+        _merge_pending()
+    return result
+
+
+def objectify_xml(path_buf_stream,
+                  strip_ns=False,
+                  strip_whitespace=True,
+                  use_expat=False,
+                  encoding=_DEFAULT_ENCODING,
+                  chunk_size=_READ_CHUNK_SIZE,
+                  force_list=None,
+                  compact=False,
+                  from_string=False):
+    """Convert an XML file, stream or string into a Python dict suitable for JSON
+
+    in: path_buf_stream:
+      (str) A string file path containing XML
+      (stream) An open readable stream from a file containing XML
+      (str) A string of XML content (also requires `from_string=True`)
+
+    The input is read and fed to the parser `chunk_size` characters at a
+    time, so parsing overlaps with reading and the raw text of the document
+    is never held in memory all at once
+
+    Set `use_expat=True` to build the dict directly from the parser callbacks
+    rather than building an ElementTree first and then converting it. The
+    result is the same, but only one copy of the document is ever in memory
+
+    By default a tag becomes a list only where it is repeated, so the same
+    tag can be a list in one place and a single value in another. To keep
+    the shape consistent, set `force_list` to a tag, or a list of the tags
+    (after namespace stripping, if strip_ns=True), that should always be
+    lists. Set `force_list='auto'` to use every tag that is repeated anywhere
+    in the document; this takes an extra pass over the tree, so it can't be used
+    with use_expat=True
+
+    Set `compact=True` to build plain dicts instead of OrderedDicts. Plain
+    dicts keep insertion order as well and take much less memory
+    """
+    if force_list == 'auto' and use_expat is True:
+        raise RuntimeError('force_list="auto" is not supported with use_expat=True')
+
+    chunks = (path_buf_stream, ) if from_string is True else objectify_read_chunks(
+        path_buf_stream, encoding=encoding, chunk_size=chunk_size)
+
+    if use_expat is True:
+        return _expat_to_internal(
+            chunks, strip_ns=strip_ns, strip_whitespace=strip_whitespace,
+            force_list=_force_list_tags(force_list), compact=compact)
+
+    parser = ET.XMLParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    root = parser.close()
+    tag_names = _TagNames(strip_ns)
+    if force_list == 'auto':
+        force_list = _repeated_tags((root, ), tag_names)
+    return _elem_to_internal(
+        root, strip_ns=strip_ns, strip_whitespace=strip_whitespace,
+        force_list=_force_list_tags(force_list), compact=compact,
+        tag_names=tag_names)
+
+
+def objectify_xml_records(path_buf_stream,
+                          record,
+                          strip_ns=False,
+                          strip_whitespace=True,
+                          from_string=False,
+                          force_list=None,
+                          sample=100,
+                          compact=False):
+    """Generator returning a Python dict for each record element in an XML file
+
+    in: path_buf_stream:
+      (str) A string file path containing XML
+      (stream) An open readable stream from a file containing XML
+      (stream) A string of XML content (also requires `from_string=True`)
+
+    record: the tag of the record elements, e.g. 'host', or a path to them,
+            e.g. 'ports/port'. A path starting with '/' is anchored at the
+            document root, e.g. '/nmaprun/host'. When strip_ns=False, tags
+            with a namespace must be given as '{namespace}tag'
+
+    The document is parsed incrementally with iterparse. Each record element
+    is converted with _elem_to_internal as soon as it is complete, in the same
+    {tag: value} form objectify_xml returns, and then it is cleared along with
+    any siblings that have already been processed. Content outside of records
+    is discarded as it is parsed, so memory usage is bounded by the size of a
+    single record rather than the size of the document
+
+    Records nested inside another record are returned as part of the outer
+    record, not on their own
+
+    force_list works as it does for objectify_xml, and is the only way to make
+    sure every record has the same shape. With `force_list='auto'`, the first
+    `sample` records are held back and the tags repeated in any of them are
+    used for all of the records
+
+    compact works as it does for objectify_xml. Key strings are shared by all
+    of the records
+
+    for host in objectify_xml_records('nmap.xml', 'host'):
+        print(host['host']['address'])
+    """
+    if from_string is True:
+        assert isinstance(path_buf_stream, str)
+        path_buf_stream = StringIO(path_buf_stream)
+
+    anchored = record.startswith('/')
+    record_path = record.strip('/').split('/')
+    depth = len(record_path)
+
+    # Records held back to learn from when force_list='auto'
+    sampled = None
+    if force_list == 'auto':
+        sampled = []
+        force_list = None
+    force_list = _force_list_tags(force_list)
+    tag_names = _TagNames(strip_ns)
+    attr_names = _AttrNames()
+
+    def _convert(elem):
+        """Convert a single record"""
+        return _elem_to_internal(
+            elem, strip_ns=strip_ns, strip_whitespace=strip_whitespace,
+            force_list=force_list, compact=compact,
+            tag_names=tag_names, attr_names=attr_names)
+
+    def _learn():
+        """Learn the repeated tags from the sample, return the converted sample"""
+        nonlocal force_list
+        force_list = _repeated_tags(sampled, tag_names)
+        return [_convert(elem) for elem in sampled]
+
+    tags = []
+    parents = []
+    record_elem = None
+    for event, elem in ET.iterparse(path_buf_stream, events=('start', 'end')):
+        if event == 'start':
+            tags.append(tag_names[elem.tag])
+            parents.append(elem)
+            if record_elem is None and tags[-depth:] == record_path:
+                if anchored is False or len(tags) == depth:
+                    record_elem = elem
+            continue
+
+        tags.pop()
+        parents.pop()
+        if elem is record_elem:
+            record_elem = None
+            if sampled is not None:
+                # Hold on to the record, it is only dropped from its parent below
+                sampled.append(elem)
+                if len(sampled) >= sample:
+                    converted = _learn()
+                    sampled = None
+                    yield from converted
+                if parents:
+                    del parents[-1][:]
+                continue
+            yield _convert(elem)
+        if record_elem is None:
+            # Nothing outside of a record is needed once it is complete. All
+            # children of the parent are complete at this point, so drop them
+            elem.clear()
+            if parents:
+                del parents[-1][:]
+
+    if sampled:
+        # Fewer records than the sample size
+        yield from _learn()
+
+
+# The encoding named in an XML declaration, e.g. <?xml version="1.0" encoding="UTF-8"?>
+_XML_DECLARATION_ENCODING = re.compile(
+    br'^<\?xml[^>]*?\sencoding\s*=\s*["\']([A-Za-z][A-Za-z0-9._-]*)["\']')
+
+
+def _xml_text_chunks(path_buf_stream, encoding=None, chunk_size=_READ_CHUNK_SIZE):
+    """Generator returning the text of an XML file or stream in chunks
+
+    Files and binary streams are read as bytes and decoded the way an XML
+    parser would: with `encoding` if it is given, otherwise as named by a
+    byte order mark or the XML declaration, and as UTF-8 if there is neither.
+    Text streams are returned as they are
+    """
+    if getattr(path_buf_stream, 'read', None) is None:
+        path_buf_stream = open(path_buf_stream, 'rb')
+    chunks = objectify_read_chunks(path_buf_stream, chunk_size=chunk_size)
+    first = next(chunks, None)
+    if first is None:
+        return
+    if isinstance(first, str):
+        yield first
+        yield from chunks
+        return
+
+    if encoding is None:
+        # Make sure the whole declaration is in the first chunk
+        while b'>' not in first and len(first) < 1024:
+            more = next(chunks, None)
+            if more is None:
+                break
+            first += more
+        if first.startswith(BOM_UTF8):
+            encoding = 'utf-8-sig'
+        elif first.startswith((BOM_UTF16_LE, BOM_UTF16_BE)):
+            encoding = 'utf-16'
+        else:
+            declared = _XML_DECLARATION_ENCODING.match(first)
+            encoding = declared.group(1).decode('ascii') if declared else 'utf-8'
+    decode = getincrementaldecoder(encoding)().decode
+    yield decode(first)
+    for chunk in chunks:
+        yield decode(chunk)
+    yield decode(b'', True)
+
+
+def _scan_records(chunks, record):
+    """Generator returning the raw text of each complete record element
+
+    This is a cheap text scanner, not a parser, so it has limits: the record
+    elements must not contain other elements with the same tag, the tag must
+    not appear inside comments or CDATA, a '>' in an attribute value of the
+    record element itself is not allowed, and end tags must be written as
+    '</tag>' with no whitespace
+    """
+    start_token = '<' + record
+    end_token = '</' + record + '>'
+    buf = ''
+    pos = 0
+    for chunk in chunks:
+        buf = buf[pos:] + chunk
+        pos = 0
+        while True:
+            start = buf.find(start_token, pos)
+            if start == -1:
+                # Keep enough to find a start tag split across chunks
+                pos = max(pos, len(buf) - len(start_token))
+                break
+            after = start + len(start_token)
+            if after >= len(buf):
+                pos = start
+                break
+            if buf[after] not in ' \t\r\n/>':
+                # A longer tag that starts with the same name
+                pos = after
+                continue
+            close = buf.find('>', after)
+            if close == -1:
+                pos = start
+                break
+            if buf[close - 1] == '/':
+                # Self-closing record
+                pos = close + 1
+                yield buf[start:pos]
+                continue
+            end = buf.find(end_token, close)
+            if end == -1:
+                pos = start
+                break
+            pos = end + len(end_token)
+            yield buf[start:pos]
+
+
+def _convert_record_batch(batch, options):
+    """Convert a batch of raw records, this runs in a worker process
+
+    Returns a list holding a {tag: value} dict for each record, or its JSON
+    text if options['as_json'] is True
+    """
+    root = ET.fromstring('<batch>' + batch + '</batch>')
+    tag_names = _TagNames(options['strip_ns'])
+    attr_names = _AttrNames()
+    records = [_elem_to_internal(
+        elem, strip_ns=options['strip_ns'],
+        strip_whitespace=options['strip_whitespace'],
+        force_list=options['force_list'], compact=options['compact'],
+        tag_names=tag_names, attr_names=attr_names) for elem in root]
+    if options['as_json'] is True:
+        ensure_ascii = options['ensure_ascii']
+        return [dumps(record, ensure_ascii=ensure_ascii) for record in records]
+    return records
+
+
+def objectify_xml_records_parallel(path_buf_stream,
+                                   record,
+                                   strip_ns=False,
+                                   strip_whitespace=True,
+                                   force_list=None,
+                                   compact=False,
+                                   as_json=False,
+                                   ensure_ascii=True,
+                                   workers=None,
+                                   batch_size=1000,
+                                   encoding=None,
+                                   chunk_size=_READ_CHUNK_SIZE):
+    """Generator returning each record element of an XML file, converted in parallel
+
+    This returns the same thing as objectify_xml_records, in the same order,
+    but spreads the conversion across a pool of `workers` processes. The
+    calling process only reads the input and cuts it into batches of
+    `batch_size` complete record elements with a cheap text scanner; parsing
+    and conversion happen in the workers. At most two batches per worker are
+    in flight at once, so memory stays bounded
+
+    Like objectify_xml_records, the file is decoded as its XML declaration
+    says, or as UTF-8 if it doesn't say. Set `encoding` to override that
+
+    Set `as_json=True` to get the JSON text of each record instead of a dict.
+    The JSON is built in the workers, which is cheaper than sending the dicts
+    back to this process. Non-ASCII characters are escaped unless
+    `ensure_ascii=False`
+
+    Because the input is not parsed before it is split, `record` must be the
+    tag name exactly as it appears in the file (e.g. 'host' or 'ns:item', not
+    a path) and each record must be well-formed on its own, i.e. it can't rely
+    on namespace prefixes or entities declared outside of it. See _scan_records
+    for the other limits of the scanner. force_list='auto' is not supported
+    since each worker would learn something different
+    """
+    if '/' in record:
+        raise RuntimeError('record must be a single tag, not a path')
+    if force_list == 'auto':
+        raise RuntimeError('force_list="auto" is not supported in parallel')
+
+    options = {
+        'strip_ns': strip_ns,
+        'strip_whitespace': strip_whitespace,
+        'force_list': _force_list_tags(force_list),
+        'compact': compact,
+        'as_json': as_json,
+        'ensure_ascii': ensure_ascii
+    }
+
+    def _batches():
+        """Group the raw records into batches of batch_size"""
+        batch = []
+        chunks = _xml_text_chunks(path_buf_stream, encoding=encoding, chunk_size=chunk_size)
+        for raw_record in _scan_records(chunks, record):
+            batch.append(raw_record)
+            if len(batch) >= batch_size:
+                yield '\n'.join(batch)
+                batch = []
+        if batch:
+            yield '\n'.join(batch)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for _, future in _submit_bounded(pool, _convert_record_batch, _batches(),
+                                         2 * _pool_size(workers), options):
+            yield from future.result()
+
+
+def _compile_paths(paths):
+    """Build a tree out of the paths to extract, with one node per tag
+
+    Each node is (children, attrs, texts) where children maps a tag to its
+    node, attrs maps an '@attr' key to the paths that want its value and
+    texts lists the paths that want the text of the element. A path that
+    does not end with '@attr' or '#text' wants the text of its last tag
+    """
+    tree = ({}, {}, [])
+    for path in paths:
+        parts = path.strip('/').split('/')
+        want = '#text'
+        if parts[-1].startswith('@') or parts[-1] == '#text':
+            want = parts.pop()
+        node = tree
+        for tag in parts:
+            node = node[0].setdefault(tag, ({}, {}, []))
+        if want == '#text':
+            node[2].append(path)
+        else:
+            node[1].setdefault(want, []).append(path)
+    return tree
+
+
+def _extract(chunks, paths, record=None, strip_ns=False, strip_whitespace=True):
+    """Generator returning a {path: [values]} dict per record, using expat
+
+    With no record, the paths start at the root element and a single dict
+    is returned for the whole document. Otherwise the paths are relative to
+    each record element, found the same way as objectify_xml_records does
+
+    Nothing is built for elements that are not on one of the paths; once a
+    tag does not match, everything below it is ignored until its end tag
+    """
+    tree = _compile_paths(paths)
+    tag_names = _ExpatTagNames(strip_ns)
+    attr_names = _ExpatAttrNames()
+
+    # Completed results, returned after each chunk is parsed
+    results = []
+    # Each wanted open element is [node, text chunks or None, still in text]
+    stack = []
+    # Depth inside a subtree that matches nothing
+    skip = 0
+    # Tags of the open elements outside of any record
+    tags = []
+    current = None
+
+    if record is None:
+        # Stand-in for the document, the root element is its child
+        current = {path: [] for path in paths}
+        stack.append([tree, None, False])
+    else:
+        anchored = record.startswith('/')
+        record_path = record.strip('/').split('/')
+        depth = len(record_path)
+
+    def _open(node, attrs):
+        """Start a wanted element, picking out any wanted attributes"""
+        if node[1]:
+            attrs = {attr_names[key]: value for key, value in zip(attrs[::2], attrs[1::2])}
+            for key, attr_paths in node[1].items():
+                if key in attrs:
+                    for path in attr_paths:
+                        current[path].append(attrs[key])
+        stack.append([node, [] if node[2] else None, True])
+
+    def _start(tag, attrs):
+        """Descend into a wanted element, or start skipping"""
+        nonlocal skip, current
+        if skip:
+            skip += 1
+            return
+        tag = tag_names[tag]
+        if stack:
+            parent = stack[-1]
+            # Any more text belongs to the tail of this child, not the parent
+            parent[2] = False
+            node = parent[0][0].get(tag)
+            if node is None:
+                skip = 1
+                return
+            _open(node, attrs)
+            return
+        # Outside of a record, check whether this starts one
+        tags.append(tag)
+        if tags[-depth:] == record_path and (anchored is False or len(tags) == depth):
+            # Records are tracked on the stack instead
+            tags.pop()
+            current = {path: [] for path in paths}
+            _open(tree, attrs)
+
+    def _end(_tag):
+        """Finish the text of a wanted element, and the record if it ends"""
+        nonlocal skip, current
+        if skip:
+            skip -= 1
+            return
+        if not stack:
+            tags.pop()
+            return
+        node, text, _ = stack.pop()
+        if text is not None:
+            text = ''.join(text)
+            if strip_whitespace is True:
+                text = text.strip()
+            for path in node[2]:
+                current[path].append(text or None)
+        if not stack:
+            # The end of a record
+            results.append(current)
+            current = None
+
+    def _data(data):
+        """Collect the text of a wanted element, up to its first child"""
+        if not skip and stack:
+            entry = stack[-1]
+            if entry[1] is not None and entry[2] is True:
+                entry[1].append(data)
+
+    parser = ParserCreate(namespace_separator='}')
+    parser.ordered_attributes = True
+    parser.buffer_text = True
+    parser.StartElementHandler = _start
+    parser.EndElementHandler = _end
+    parser.CharacterDataHandler = _data
+    for chunk in chunks:
+        parser.Parse(chunk, False)
+        yield from results
+        del results[:]
+    parser.Parse('', True)
+    yield from results
+    if record is None:
+        yield current
+
+
+def objectify_xml_extract(path_buf_stream,
+                          paths,
+                          strip_ns=False,
+                          strip_whitespace=True,
+                          from_string=False,
+                          encoding=_DEFAULT_ENCODING,
+                          chunk_size=_READ_CHUNK_SIZE):
+    """Pull the values at a few simple paths out of an XML document
+
+    Rather than converting the whole document, the values are picked out as
+    the document is parsed. Anything that is not on one of the paths is
+    skipped without building anything for it
+
+    paths: an iterable of paths starting at the root element, e.g.
+      'nmaprun/host/address/@addr' - the value of an attribute
+      'nmaprun/host/status/#text'  - the text of an element
+      'nmaprun/host/status'        - the same as '.../#text'
+
+    Returns a dict mapping each path to a list of every value found for it,
+    in document order. Missing attributes are left out, elements without
+    text give None
+
+    When strip_ns=True, tags in the paths are given without the namespace,
+    otherwise as '{namespace}tag'
+    """
+    chunks = (path_buf_stream, ) if from_string is True else objectify_read_chunks(
+        path_buf_stream, encoding=encoding, chunk_size=chunk_size)
+    return next(_extract(chunks, paths, strip_ns=strip_ns, strip_whitespace=strip_whitespace))
 
 
-def objectify_xml(path_buf_stream, strip_ns=False, strip_whitespace=True):
-    """Convert an XML string into a Python dict suitable for JSON"""
-    def _elem2json(elem, strip_ns=True, strip_whitespace=True):
-        """Convert an ElementTree or Element into a JSON string"""
-        if hasattr(elem, 'getroot'):
-            elem = elem.getroot()
-        return _elem_to_internal(elem,
-                                 strip_ns=strip_ns,
-                                 strip_whitespace=strip_whitespace)
+def objectify_xml_extract_records(path_buf_stream,
+                                  paths,
+                                  record,
+                                  strip_ns=False,
+                                  strip_whitespace=True,
+                                  from_string=False,
+                                  encoding=_DEFAULT_ENCODING,
+                                  chunk_size=_READ_CHUNK_SIZE):
+    """Generator returning the values at a few simple paths for each record
 
-    xmlstring = objectify_read(path_buf_stream)
+    This combines objectify_xml_extract with objectify_xml_records: `record`
+    is a tag or path as accepted by objectify_xml_records, and the paths are
+    relative to each record element, e.g. '@starttime' or 'address/@addr'.
+    One {path: [values]} dict is returned per record
 
-    elem = ET.fromstring(xmlstring)
-    return _elem2json(
-        elem, strip_ns=strip_ns, strip_whitespace=strip_whitespace)
+    for values in objectify_xml_extract_records('nmap.xml', ['address/@addr'], 'host'):
+        print(values['address/@addr'])
+    """
+    chunks = (path_buf_stream, ) if from_string is True else objectify_read_chunks(
+        path_buf_stream, encoding=encoding, chunk_size=chunk_size)
+    return _extract(chunks, paths, record=record,
+                    strip_ns=strip_ns, strip_whitespace=strip_whitespace)
 
 
 def main():
@@ -121,7 +872,7 @@ def main():
     if strip_line_endings is True:
         buf = buf.replace('\n', '').replace('\r', '')
 
-    obj = objectify_xml(buf)
+    obj = objectify_xml(buf, from_string=True)
     objectify_write(outfile, obj, as_json=True)
     print('Conversion complete, please see {} ...'.format(outfile))
 
@@ -22,18 +22,90 @@ ssh_key: "{{ ssh_root }}/id_rsa"
 
 For things like configuration files, the order is preserved when loaded
 There are basic checks for duplicate keys
+
+The libyaml based CSafeLoader/CSafeDumper are used when PyYAML was built
+with libyaml, otherwise the pure Python SafeLoader/SafeDumper. LIBYAML,
+YAML_LOADER and YAML_DUMPER show which are in use
 """
 from collections import OrderedDict
-from re import compile as regex_compile
-from sys import stderr
+from concurrent.futures import ProcessPoolExecutor
 from io import StringIO
 
-from yaml import (safe_load as load_yaml_plain, YAMLError as YAMLException)
+from yaml import (load as load_yaml, load_all as load_yaml_all, YAMLError as YAMLException)
+from yaml.constructor import ConstructorError
+from yaml.resolver import BaseResolver
+try:
+    # Use libyaml when PyYAML was built with it, it is much faster
+    from yaml import (CSafeLoader as YAML_LOADER, CSafeDumper as YAML_DUMPER)
+    LIBYAML = True
+except ImportError:
+    from yaml import (SafeLoader as YAML_LOADER, SafeDumper as YAML_DUMPER)
+    LIBYAML = False
 
-from objectify.log import error_frame, error, debug
+from objectify.log import error_frame, error, debug, info
 from objectify.encoding import _DEFAULT_ENCODING
-from objectify.template import recursive_template
+from objectify.template import (
+    _BatchTemplate,
+    LazyTemplate,
+    ordered_template,
+    recursive_template,
+    template_passes)
 from objectify.io import objectify_read
+from objectify.pool import _pool_size, _submit_bounded
+
+_MERGE_TAG = 'tag:yaml.org,2002:merge'
+
+# The document being rendered by objectify_yaml_render_many, in a worker process
+_WORKER_TEMPLATE = None
+
+
+class DuplicateKeyError(ConstructorError):
+    """A mapping in the YaML contains the same key more than once"""
+
+
+class _UniqueKeyLoader(YAML_LOADER):
+    """YAML_LOADER that refuses duplicate keys in any mapping, at any level"""
+
+
+def _construct_unique_mapping(loader, node):
+    """Construct a mapping, raising DuplicateKeyError on a repeated key
+
+    The check is done on the nodes as the mapping is constructed, so there
+    is no extra pass over the text. Keys pulled in with a '<<' merge may
+    be overridden, only the keys written in the mapping itself are checked
+    """
+    seen = {}
+    for key_node, _ in node.value:
+        if key_node.tag == _MERGE_TAG:
+            continue
+        key = loader.construct_object(key_node)
+        try:
+            first = seen.setdefault(key, key_node)
+        except TypeError:
+            # Unhashable, construct_mapping raises a proper error for these
+            continue
+        if first is not key_node:
+            raise DuplicateKeyError(
+                'while constructing a mapping', node.start_mark,
+                'found duplicate key "{}", first defined on line {}, column {}'.format(
+                    key, first.start_mark.line + 1, first.start_mark.column + 1),
+                key_node.start_mark)
+    # construct_yaml_map is a generator, which lets aliases refer back to
+    # a mapping that is still being constructed
+    yield from loader.construct_yaml_map(node)
+
+
+_UniqueKeyLoader.add_constructor(BaseResolver.DEFAULT_MAPPING_TAG, _construct_unique_mapping)
+
+
+def _ordered(data):
+    """Return a loaded document with an OrderedDict at the top level"""
+    if data is None:
+        return OrderedDict()
+    if isinstance(data, dict):
+        # Loaded dicts keep the order of the file already
+        return OrderedDict(data)
+    return data
 
 
 def objectify_yaml(path_buf_stream,
@@ -42,7 +114,10 @@ def objectify_yaml(path_buf_stream,
                    extra_vars=None,
                    passes=2,
                    user_path_expand=False,
-                   encoding=_DEFAULT_ENCODING):
+                   encoding=_DEFAULT_ENCODING,
+                   dependency_order=False,
+                   report_passes=False,
+                   lazy=False):
     """Load a YaML file, stream or string into a Python3 object, optionally templating
 
     This function can be used to perform an ordered load of a YaML file
@@ -72,16 +147,35 @@ def objectify_yaml(path_buf_stream,
     To activate templating with an external data source, specify `template=True`
     as well as extra_vars={"some": "dict"}
 
-    To expand values such as "~username" set `expand_user=True`
+    Values such as "~username" inside the document are expanded with
+    expanduser. `user_path_expand=True` also expands a document that is a
+    single string, when it is templated with extra_vars
+
+    Only a mapping can template itself. A document that is a list or a
+    single value is returned as it is loaded, or templated once with
+    extra_vars if they are given
 
     You can perform multiple self-templating passes using the `passes=n` parameter
     where n is the amount of passes to make. Usually there is no need for more
-    than one
+    than one. Passes stop early once a pass changes nothing, so a high value
+    costs nothing extra. Set `report_passes=True` to write how many passes were
+    used to stderr
+
+    Alternately, set `dependency_order=True` to look at which keys each value
+    refers to and render the values in that order, each exactly once. Chains
+    of references of any length are resolved and `passes` is not used. Keys
+    that refer to each other in a cycle raise a RuntimeError naming them
+
+    For large files of which only a few values are needed, set `lazy=True`
+    to get a read-only Mapping that renders each top-level value the first
+    time it is read, in dependency order, and keeps it. Its materialize()
+    method renders the rest and returns an OrderedDict. Nothing is rendered
+    up front, so values that are never read cost nothing
 
-    TODO: Allow deeply nested templating. This requires breaking up the full key
-          path/namespace into a list of keys to follow. This also may require
-          awareness of datatypes (e.g. lists) so requires a bit more code to do
-          correctly. For now there is no use-case, so it is not implelemented
+    Nested keys and list indexes can be referenced as `{{ db.primary.host }}`
+    or `{{ hosts[0] }}`. With `dependency_order=True` these are followed too,
+    so a value referencing a nested value that is itself templated is still
+    resolved in a single pass
 
     """
     if from_string is False:
@@ -91,21 +185,152 @@ def objectify_yaml(path_buf_stream,
     if template is False:
         debug('skipping ordered YaML templateing, template=False')
         return first_pass_data
+    return _template_yaml(first_pass_data, extra_vars=extra_vars, passes=passes,
+                          user_path_expand=user_path_expand,
+                          dependency_order=dependency_order,
+                          report_passes=report_passes,
+                          lazy=lazy)
+
+
+def objectify_yaml_documents(path_buf_stream,
+                             from_string=False,
+                             template=False,
+                             extra_vars=None,
+                             passes=2,
+                             user_path_expand=False,
+                             encoding=_DEFAULT_ENCODING,
+                             dependency_order=False,
+                             report_passes=False):
+    """Generator returning each document in a multi-document YaML file, stream or string
+
+    Documents are separated by '---' and are parsed and returned one at a
+    time, so a stream of hundreds of thousands of documents is processed
+    in bounded memory. The file or stream is read incrementally, it is never
+    read into a single string
+
+    Each document is loaded the same way objectify_yaml loads a file, with
+    the same checks for duplicate keys. With `template=True` each document is
+    templated on its own, using extra_vars or, by default, itself, with the
+    same `passes`, `dependency_order` and `report_passes` options as
+    objectify_yaml
+
+    for host in objectify_yaml_documents('inventory.yml'):
+        print(host['name'])
+    """
+    if from_string is True:
+        path_buf_stream = StringIO(path_buf_stream)
+    reader = getattr(path_buf_stream, 'read', None)
+
+    with (path_buf_stream if reader else open(path_buf_stream, 'r', encoding=encoding)) as infd:
+        try:
+            for data in load_yaml_all(infd, Loader=_UniqueKeyLoader):
+                data = _ordered(data)
+                if template is True:
+                    data = _template_yaml(data, extra_vars=extra_vars, passes=passes,
+                                          user_path_expand=user_path_expand,
+                                          dependency_order=dependency_order,
+                                          report_passes=report_passes)
+                yield data
+        except DuplicateKeyError as err:
+            error('YaML contains duplicate keys')
+            error(str(err))
+            exit(1)
+        except YAMLException as err:
+            error('Parse error, invalid YaML')
+            error_frame(repr(err))
+
+
+def _init_render_worker(template):
+    """Keep the compiled document around in a worker process"""
+    global _WORKER_TEMPLATE
+    _WORKER_TEMPLATE = template
+
+
+def _render_batch(var_sets):
+    """Render the compiled document for a batch of variable sets, this runs
+    in a worker process"""
+    return [_WORKER_TEMPLATE.render(template_vars) for template_vars in var_sets]
+
+
+def objectify_yaml_render_many(path_buf_stream,
+                               var_sets,
+                               from_string=False,
+                               encoding=_DEFAULT_ENCODING,
+                               workers=0,
+                               batch_size=100):
+    """Generator rendering one YaML template for each of many sets of variables
+
+    This returns, in order, what objectify_yaml(..., extra_vars=template_vars,
+    dependency_order=True) would return for each dict in `var_sets`, which can
+    be a list or any iterator. The file is loaded, and the references between
+    its values worked out, only once. The document is rendered once without
+    any variables, then for each set of variables only the values that refer,
+    directly or through other values, to one of its names are rendered again
+
+    for host, config in zip(hosts, objectify_yaml_render_many('host.yml', hosts)):
+        ...
+
+    Set `workers` to render in a pool of that many processes, or None for
+    one per CPU, in batches of `batch_size` variable sets. This only pays off
+    for a very large amount of variable sets, as each document has to be
+    sent back to this process
+    """
+    if from_string is False:
+        path_buf_stream = objectify_read(path_buf_stream, encoding=encoding)
+
+    template = _BatchTemplate(_load_yaml_ordered(path_buf_stream))
+    if workers == 0:
+        for template_vars in var_sets:
+            yield template.render(template_vars)
+        return
+
+    def _batches():
+        """Group the variable sets into batches of batch_size"""
+        batch = []
+        for template_vars in var_sets:
+            batch.append(template_vars)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker,
+                             initargs=(template,)) as pool:
+        for _, future in _submit_bounded(pool, _render_batch, _batches(), 2 * _pool_size(workers)):
+            yield from future.result()
+
+
+def _template_yaml(first_pass_data, extra_vars=None, passes=2, user_path_expand=False,
+                   dependency_order=False, report_passes=False, lazy=False):
+    """Template a loaded YaML document with extra_vars or, by default, itself
+
+    Only a mapping can template itself. Any other document, such as a list,
+    is returned as it is, or templated once if extra_vars is given
+    """
+    if extra_vars is not None and not isinstance(extra_vars, dict):
+        error_frame('unable to load extra_vars, must be dict()')
+        exit(1)
+    if not isinstance(first_pass_data, dict):
+        if extra_vars is None:
+            return first_pass_data
+        return recursive_template(first_pass_data, extra_vars, user_path_expand=user_path_expand)
+
+    if dependency_order is True or lazy is True:
+        if lazy is True:
+            return LazyTemplate(first_pass_data, extra_vars)
+        return ordered_template(first_pass_data, extra_vars)
+
     # Parse the YaML into a dictionary and then apply
     # that to the original YaML as if it was a template
     # itself. Allows nested/self-referential templating
     # in YaML files
     if extra_vars is None:
         extra_vars = first_pass_data
-
-    if isinstance(extra_vars, dict):
-        first_pass_data = recursive_template(first_pass_data, extra_vars, user_path_expand=user_path_expand)
-    else:
-        error_frame('unable to load extra_vars, must be dict()')
-        exit(1)
-    next_pass_data = first_pass_data
-    for _ in range(passes):
-        next_pass_data = recursive_template(next_pass_data, next_pass_data, user_path_expand=user_path_expand)
+    first_pass_data = recursive_template(first_pass_data, extra_vars, user_path_expand=user_path_expand)
+    next_pass_data, used = template_passes(first_pass_data, passes)
+    if report_passes is True:
+        info('templating used {} of {} passes'.format(used, passes))
     return next_pass_data
 
 
@@ -122,40 +347,18 @@ def _load_yaml_ordered(yamlstring):
       None on error
       OrderedDict({}) on empty file or general (non-YaML) exception
       OrderedDict({contents}) on properly formatted YaML file
-    """
-    def _sanity_check(yamlstring):
-        """Sanity check to identify duplicate top-level keys
-
-        If there are duplicate top-level keys, they will simply overwrite
-        one-another as they are loaded into a Python dict() so it is a
-        good idea to keep this logic, though it isn't very pretty
-        """
-        lines = yamlstring.splitlines()
-        top_level_keys = []
-        duped_keys = []
-
-        yaml_key_compiled = regex_compile(r'^([A-Za-z0-9_]+) *:')
-
-        for line in lines:
-            matched = yaml_key_compiled.search(line)
-            if matched:
-                if matched.group(1) in top_level_keys:
-                    duped_keys.append(matched.group(1))
-                else:
-                    top_level_keys.append(matched.group(1))
-        if duped_keys:
-            stderr.write('YaML file %s contains duplicate top-level keys\n',
-                         duped_keys)
-            exit(1)
-        return yamlstring, top_level_keys
 
-    yamlstring, top_level_keys = _sanity_check(yamlstring)
+    Duplicate keys in any mapping are fatal, the line and column of both
+    occurrences are reported
+    """
     yamlfd = StringIO(yamlstring)
 
-    # 2nd pass to set up the OrderedDict
     try:
-        dict_tmp = load_yaml_plain(yamlfd)
-        return OrderedDict([(key, dict_tmp[key]) for key in top_level_keys])
+        return _ordered(load_yaml(yamlfd, Loader=_UniqueKeyLoader))
+    except DuplicateKeyError as err:
+        error('YaML contains duplicate keys')
+        error(str(err))
+        exit(1)
     except YAMLException as err:
         error('Parse error, invalid YaML')
         error_frame(repr(err))
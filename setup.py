@@ -45,6 +45,10 @@ setup(
     name=NAME,
     packages=find_packages(),
     install_requires=REQUIRED,
+    entry_points={
+        'console_scripts': [
+            'objectify-xml2jsonl=objectify.convert:main',
+            'objectify-batch=objectify.batch:main']},
     author=AUTHOR,
     author_email=EMAIL,
     description=DESCRIPTION,
@@ -23,11 +23,17 @@ from objectify.lines import objectify_lines
 from objectify.io import objectify_write
 
 
+def _objectify_yaml_lazy(infile):
+    """Load a YaML file with lazy=True and render all of it"""
+    return objectify_yaml(infile, lazy=True).materialize()
+
+
 def main():
     """Test driver"""
     infile = argv[1]
 
     loadmap = {
+        '.lazy.yml': (_objectify_yaml_lazy, {}, (dict, OrderedDict)),
         '.json': (objectify_json, {}, (dict, OrderedDict)),
         '.yaml': (objectify_yaml, {}, (dict, OrderedDict)),
         '.yml': (objectify_yaml, {'template': True}, (dict, OrderedDict)),